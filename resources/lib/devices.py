@@ -0,0 +1,193 @@
+# devices.py - table of cast devices discovered by the service
+#
+# Copyright 2016 kharts (https://github.com/kharts)
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+
+import os
+import json
+import threading
+import time
+import xbmc
+import xbmcgui
+from common import *
+
+
+HOME_WINDOW_ID = 10000
+DEVICES_PROPERTY = addonID + ".devices"
+DEVICE_CACHE_FILE = "devices.json"
+ZEROCONF_CACHE_FILE = "zeroconf.cache"
+
+
+class DeviceRegistry(object):
+    """
+    Table of cast devices, kept up to date by the background service.
+    The table is published as a property of Kodi home window, so the plugin
+    can read it instantly instead of discovering devices again.
+    """
+
+    def __init__(self, device_cache=None):
+        """
+        :param device_cache: persistent cache, which is updated with
+            discovered devices
+        :type device_cache: pychromecast.DeviceCache
+        """
+
+        self.devices = {}
+        # uuids of cast group members, by group uuid
+        self.groups = {}
+        self.lock = threading.Lock()
+        self.device_cache = device_cache
+
+    def add_device(self, name, service):
+        """
+        Add or refresh discovered device.
+        Is called by pychromecast.CastListener
+        :param name: zeroconf service name of the device
+        :type name: str
+        :param service: tuple (ip, port, uuid, model_name, friendly_name)
+        :type service: tuple
+        :return: None
+        """
+
+        host, port, uuid, model_name, friendly_name = service
+        with self.lock:
+            self.devices[name] = {"name": friendly_name or host,
+                                  "host": host,
+                                  "port": port,
+                                  "uuid": uuid,
+                                  "model": model_name,
+                                  "last_seen": time.time()}
+            self.publish()
+        if self.device_cache is not None:
+            self.device_cache.update([service])
+
+    def remove_device(self, name, service):
+        """
+        Remove device, which has disappeared from the network.
+        Is called by pychromecast.CastListener
+        :param name: zeroconf service name of the device
+        :type name: str
+        :param service: tuple (ip, port, uuid, model_name, friendly_name)
+        :type service: tuple
+        :return: None
+        """
+
+        with self.lock:
+            if self.devices.pop(name, None) is not None:
+                self.publish()
+
+    def set_group_members(self, group_uuid, member_uuids):
+        """
+        Update members of cast group.
+        Is called by pychromecast.CastListener
+        :param group_uuid: uuid of the group
+        :type group_uuid: str
+        :param member_uuids: uuids of the member devices
+        :type member_uuids: set
+        :return: None
+        """
+
+        with self.lock:
+            if member_uuids:
+                self.groups[group_uuid] = set(member_uuids)
+            else:
+                self.groups.pop(group_uuid, None)
+            self.publish()
+
+    def publish(self):
+        """
+        Publish device table for the plugin.
+        Cast groups get the names of their members in "members"
+        :return: None
+        """
+
+        names = {device["uuid"]: device["name"]
+                 for device in self.devices.values()}
+        table = []
+        for device in self.devices.values():
+            device = dict(device)
+            members = self.groups.get(device["uuid"])
+            if members:
+                device["members"] = sorted(names[uuid] for uuid in members
+                                           if uuid in names)
+            table.append(device)
+        home_window = xbmcgui.Window(HOME_WINDOW_ID)
+        home_window.setProperty(DEVICES_PROPERTY, json.dumps(table))
+
+    def clear(self):
+        """
+        Remove published device table (when service is stopped)
+        :return: None
+        """
+
+        with self.lock:
+            self.devices = {}
+            self.groups = {}
+            xbmcgui.Window(HOME_WINDOW_ID).clearProperty(DEVICES_PROPERTY)
+
+
+def get_device_cache_path():
+    """
+    Get path to the persistent cache of cast devices
+    (pychromecast.DeviceCache), stored in addon profile folder
+    :return: full filename of the cache
+    :rtype: str
+    """
+
+    return get_profile_path(DEVICE_CACHE_FILE)
+
+
+def get_zeroconf_cache_path():
+    """
+    Get path to the snapshot of mDNS cache, kept by the background
+    service over Kodi restarts
+    :return: full filename of the snapshot
+    :rtype: str
+    """
+
+    return get_profile_path(ZEROCONF_CACHE_FILE)
+
+
+def get_profile_path(filename):
+    """
+    Get path to a file in addon profile folder, creating the folder
+    if needed
+    :param filename: name of the file
+    :type filename: str
+    :return: full filename
+    :rtype: str
+    """
+
+    profile_folder = xbmc.translatePath(this_addon.getAddonInfo("profile"))
+    if not os.path.exists(profile_folder):
+        try:
+            os.makedirs(profile_folder)
+        except Exception, e:
+            log_exception("Couldn't create profile folder")
+            log_exception(str(e))
+    return os.path.join(profile_folder, filename)
+
+
+def get_devices():
+    """
+    Get cast devices, discovered by the background service
+    :return: list of dicts with keys "name", "host", "port", "uuid",
+        "model", "last_seen" (and "members" for cast groups)
+        sorted by name, or None if the service
+        doesn't publish device table
+    :rtype: list or None
+    """
+
+    text = xbmcgui.Window(HOME_WINDOW_ID).getProperty(DEVICES_PROPERTY)
+    if not text:
+        return None
+    try:
+        devices = json.loads(text)
+    except Exception, e:
+        log_exception("Couldn't parse device table")
+        log_exception(str(e))
+        return None
+    return sorted(devices, key=lambda device: device["name"])
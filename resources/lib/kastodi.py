@@ -13,11 +13,15 @@ import urllib
 import shutil
 from xml.etree import ElementTree as ET
 import json
+import threading
 import xbmc
 import xbmcgui
 import xbmcaddon
 from common import *
 from cast_controls import CastControlsDialog
+from select_dialog import SelectCastDialog
+from devices import DeviceRegistry
+import devices
 
 
 # add resources/lib folder to path variable
@@ -45,39 +49,125 @@ def cast_button_pressed():
     :return: None
     """
 
-    progress_dialog = xbmcgui.DialogProgress()
-    progress_dialog.create("Discovering cast devices...")
-    chromecasts = pychromecast.get_chromecasts_as_dict(tries=TRIES).keys()
-    if progress_dialog.iscanceled():
-        progress_dialog.close()
-        return
-    progress_dialog.close()
-    if not chromecasts:
-        info("No cast devices connected")
-        return
-    select_chromecast_dialog = xbmcgui.Dialog()
-    index = select_chromecast_dialog.select("Cast to",
-                                            chromecasts)
-    cast_name = chromecasts[index]
-    start_casting(cast_name)
+    select_dialog = SelectCastDialog()
+    known_devices = devices.get_devices()
+    if known_devices:
+        for device in known_devices:
+            service = (device["host"], device["port"], device["uuid"],
+                       device["model"], device["name"])
+            select_dialog.add_cast(device["name"],
+                                   get_lazy_cast(service),
+                                   ", ".join(device.get("members", [])))
+        select_dialog.discovery_finished()
+    else:
+        # Show devices from the previous sessions right away. They are
+        # looked up by name when selected, so stale entries fall back to
+        # discovery
+        names = set()
+        for service in get_device_cache().devices:
+            name = service[4]
+            if name and name not in names:
+                names.add(name)
+                select_dialog.add_cast(name, None)
+        discovery = threading.Thread(target=discover_casts,
+                                     args=(select_dialog, names))
+        discovery.daemon = True
+        discovery.start()
+    select_dialog.doModal()
+    if select_dialog.selected:
+        cast_name, cast = select_dialog.selected
+        start_casting(cast_name, cast)
+
+
+def discover_casts(select_dialog, names):
+    """
+    Add cast devices to selection dialog as soon as they are discovered
+    :param select_dialog: dialog to add devices to
+    :type select_dialog: SelectCastDialog
+    :param names: names of the devices, which are already in the dialog
+    :type names: set
+    :return: None
+    """
+
+    addresses = set()
+    device_cache = get_device_cache()
+    try:
+        for service in pychromecast.discover_chromecasts_iter():
+            device_cache.update([service])
+            if select_dialog.closed:
+                break
+            host, port, uuid, model_name, friendly_name = service
+            name = friendly_name or host
+            # Cast groups share the address of their leader, but not
+            # the port
+            if (host, port) in addresses or name in names:
+                continue
+            addresses.add((host, port))
+            names.add(name)
+            select_dialog.add_cast(name, get_lazy_cast(service))
+    except Exception, e:
+        log_exception("Couldn't discover cast devices")
+        log_exception(str(e))
+    if not select_dialog.closed:
+        select_dialog.discovery_finished()
+
 
+def get_device_cache():
+    """
+    Get persistent cache of cast devices
+    :return: device cache
+    :rtype: pychromecast.DeviceCache
+    """
+
+    return pychromecast.DeviceCache(devices.get_device_cache_path())
+
+
+def get_lazy_cast(service):
+    """
+    Get Chromecast object for discovered device without connecting to it
+    :param service: tuple (ip, port, uuid, model_name, friendly_name)
+    :type service: tuple
+    :return: Chromecast, which connects to the device on first use
+    :rtype: pychromecast.Chromecast
+    """
 
-def start_casting(chromecast_name):
+    device = pychromecast.get_device_status_from_service(service)
+    return pychromecast.Chromecast(service[0],
+                                   device=device,
+                                   tries=TRIES,
+                                   lazy=True,
+                                   port=service[1])
+
+
+def start_casting(chromecast_name, cast=None):
     """
     Start casting to the Chromecast with the given friendly name
     :param chromecast_name: friendly name of selected Chromecast
     :type chromecast_name: str
+    :param cast: selected Chromecast (if it is already known,
+        Chromecast isn't discovered again)
+    :type cast: pychromecast.Chromecast
     :return: None
     """
 
     progress_dialog = xbmcgui.DialogProgress()
     progress_dialog.create("Connecting to " + chromecast_name + "...")
-    cast = pychromecast.get_chromecast(friendly_name=chromecast_name,
-                                       tries=TRIES)
+    if cast:
+        try:
+            cast.wait()
+        except pychromecast.ChromecastConnectionError, e:
+            log_exception(str(e))
+            cast = None
     if not cast:
+        cast = pychromecast.get_chromecast(friendly_name=chromecast_name,
+                                           tries=TRIES,
+                                           cache=get_device_cache())
+        if cast:
+            cast.wait()
+    if not cast:
+        progress_dialog.close()
         error("Couldn't connect to " + chromecast_name)
         return
-    cast.wait()
     player = xbmc.Player()
     url = player.getPlayingFile()
     debug("url: " + url)
@@ -265,6 +355,7 @@ def get_local_ip():
     """
 
     ranges = ["10.", "172.", "192."]
+    # zeroconf reuses the addresses enumerated within the last seconds
     all_addresses = zeroconf.get_all_addresses(netifaces.AF_INET)
     for address in all_addresses:
         for ran in ranges:
@@ -291,6 +382,15 @@ def start_service():
                        "To start casting, you need to restart Kodi. Exit now?"):
             xbmc.executebuiltin("Quit()")
 
+    # Keep discovering cast devices in the background, so the plugin
+    # can show them without waiting for discovery
+    registry = DeviceRegistry(get_device_cache())
+    listener = pychromecast.CastListener(registry.add_device,
+                                         registry.remove_device,
+                                         registry.set_group_members)
+    browser = pychromecast.start_discovery(
+        listener, cache_path=devices.get_zeroconf_cache_path())
+
     monitor = xbmc.Monitor()
 
     while not monitor.abortRequested():
@@ -298,6 +398,10 @@ def start_service():
             # Abort was requested while waiting. We should exit
             break
 
+    pychromecast.stop_discovery(browser)
+    # Kodi waits for the service to exit, don't let zeroconf linger
+    pychromecast.close_shared_zeroconf()
+    registry.clear()
     delete_cast_icon()
 
 
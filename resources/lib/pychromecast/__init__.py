@@ -6,39 +6,150 @@ from __future__ import print_function
 import sys
 import logging
 import fnmatch
+import time
 
 # pylint: disable=wildcard-import
 import threading
+from six.moves import queue
 from .config import *  # noqa
 from .error import *  # noqa
 from . import socket_client
-from .discovery import discover_chromecasts
-from .dial import get_device_status, reboot
+from .discovery import (discover_chromecasts, discover_chromecasts_iter,
+                        start_discovery, stop_discovery, CastListener,
+                        get_device_status_from_service, get_shared_zeroconf,
+                        release_shared_zeroconf, close_shared_zeroconf)
+from .dial import get_device_status, parse_uuid, reboot, DeviceStatus
+from .cache import DeviceCache, probe_device
 from .controllers.media import STREAM_TYPE_BUFFERED  # noqa
 
 IDLE_APP_ID = 'E8C28D3C'
 IGNORE_CEC = []
 # For Python 2.x we need to decode __repr__ Unicode return values to str
 NON_UNICODE_REPR = sys.version_info < (3, )
+# Maximum number of devices which are connected simultaneously
+CONNECT_WORKERS = 8
+# Seconds to wait for all discovered devices to connect
+CONNECT_TIMEOUT = 30
 
 
-def _get_all_chromecasts(tries=None, retry_wait=None):
+def _get_all_chromecasts(tries=None, retry_wait=None, lazy=False):
     """
     Returns a list of all chromecasts on the network as PyChromecast
     objects.
     """
-    hosts = discover_chromecasts()
+    casts = [_get_lazy_chromecast(host, tries, retry_wait)
+             for host in discover_chromecasts()]
+
+    if lazy:
+        return casts
+
+    return _connect_chromecasts(casts)
+
+
+def _get_lazy_chromecast(host, tries=None, retry_wait=None):
+    """
+    Returns a lazy Chromecast object for a discovered device.
+
+    host is a tuple (ip, port, uuid, model_name, friendly_name),
+    as returned by discover_chromecasts.
+    """
+    return Chromecast(host=host[0], port=host[1], tries=tries,
+                      retry_wait=retry_wait,
+                      device=get_device_status_from_service(host),
+                      lazy=True)
+
+
+def _connect_chromecasts(casts, timeout=CONNECT_TIMEOUT):
+    """
+    Connects the given lazy Chromecast objects and returns the list of
+    the connected ones.
+
+    Devices are probed concurrently by at most CONNECT_WORKERS threads,
+    so one slow device doesn't delay the others. Devices which didn't
+    connect within timeout seconds are left out of the result.
+    """
+    pending = queue.Queue()
+    for cast in casts:
+        pending.put(cast)
+
     cc_list = []
-    for ip_address, _ in hosts:
-        try:
-            cc_list.append(Chromecast(host=ip_address, tries=tries,
-                                      retry_wait=retry_wait))
-        except ChromecastConnectionError:
-            pass
-    return cc_list
+    condition = threading.Condition()
+    state = {'finished': 0, 'expired': False}
+
+    def probe():
+        """ Connects to the queued devices until none are left. """
+        while not state['expired']:
+            try:
+                cast = pending.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                cast.connect()
+            except ChromecastConnectionError:
+                cast = None
+
+            with condition:
+                if cast is not None:
+                    if state['expired']:
+                        # Nobody is waiting for this device anymore
+                        cast.disconnect(blocking=False)
+                    else:
+                        cc_list.append(cast)
+                state['finished'] += 1
+                condition.notify()
+
+    for _ in range(min(CONNECT_WORKERS, len(casts))):
+        worker = threading.Thread(target=probe)
+        worker.daemon = True
+        worker.start()
+
+    deadline = time.time() + timeout
+    with condition:
+        while state['finished'] < len(casts):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                state['expired'] = True
+                break
+            condition.wait(remaining)
+
+        return list(cc_list)
+
+
+def _matches_device_filters(chromecast, filters):
+    """
+    Returns whether the ip and the device status of the Chromecast match
+    the filters. Filters on other items are ignored, so lazy Chromecast
+    objects are checked without connecting to their devices.
+    """
+    if 'ip' in filters and chromecast.host != filters['ip']:
+        return False
+
+    if not any(key in DeviceStatus._fields for key in filters):
+        return True
+
+    try:
+        device = chromecast.device
+    except ChromecastConnectionError:
+        return False
 
+    return all(val == getattr(device, key)
+               for key, val in filters.items()
+               if key in DeviceStatus._fields)
 
-def get_chromecasts(tries=None, retry_wait=None, **filters):
+
+def _matches_status_filters(chromecast, filters):
+    """
+    Returns whether the cast status of a connected Chromecast matches
+    the filters. Filters on other items are ignored.
+    """
+    status = chromecast.status
+    return all(val == getattr(status, key)
+               for key, val in filters.items()
+               if key not in DeviceStatus._fields and hasattr(status, key))
+
+
+def get_chromecasts(tries=None, retry_wait=None, lazy=False, **filters):
     """
     Searches the network and returns a list of Chromecast objects.
     Filter is a list of options to filter the chromecasts by.
@@ -55,43 +166,43 @@ def get_chromecasts(tries=None, retry_wait=None, **filters):
     Or ip address:
         ip
 
+    The ip address and DeviceStatus items are matched against discovery
+    data, before connecting to the devices.
+
     Tries is specified if you want to limit the number of times the
     underlying socket associated with your Chromecast objects will
     retry connecting if connection is lost or it fails to connect
     in the first place. The number of seconds spent between each retry
     can be defined by passing the retry_wait parameter, the default is
     to wait 5 seconds.
+
+    If lazy, the returned Chromecast objects don't connect to their devices
+    until they are used for the first time.
     """
     logger = logging.getLogger(__name__)
 
-    cc_list = set(_get_all_chromecasts(tries, retry_wait))
-    excluded_cc = set()
+    cc_list = [cast for cast in _get_all_chromecasts(tries, retry_wait,
+                                                     lazy=True)
+               if _matches_device_filters(cast, filters)]
 
-    if not filters:
-        return list(cc_list)
+    if lazy:
+        return cc_list
 
-    if 'ip' in filters:
-        for chromecast in cc_list:
-            if chromecast.host != filters['ip']:
-                excluded_cc.add(chromecast)
-        filters.pop('ip')
+    cc_list = _connect_chromecasts(cc_list)
+    filtered_cc = []
 
-    for key, val in filters.items():
-        for chromecast in cc_list:
-            for tup in [chromecast.device, chromecast.status]:
-                if hasattr(tup, key) and val != getattr(tup, key):
-                    excluded_cc.add(chromecast)
-
-    filtered_cc = cc_list - excluded_cc
-
-    for cast in excluded_cc:
-        logger.debug("Stopping excluded chromecast %s", cast)
-        cast.socket_client.stop.set()
+    for cast in cc_list:
+        if _matches_status_filters(cast, filters):
+            filtered_cc.append(cast)
+        else:
+            logger.debug("Stopping excluded chromecast %s", cast)
+            cast.disconnect(blocking=False)
 
-    return list(filtered_cc)
+    return filtered_cc
 
 
-def get_chromecasts_as_dict(tries=None, retry_wait=None, **filters):
+def get_chromecasts_as_dict(tries=None, retry_wait=None, lazy=False,
+                            **filters):
     """
     Returns a dictionary of chromecasts with the friendly name as
     the key.  The value is the pychromecast object itself.
@@ -102,13 +213,89 @@ def get_chromecasts_as_dict(tries=None, retry_wait=None, **filters):
     in the first place. The number of seconds spent between each retry
     can be defined by passing the retry_wait parameter, the default is
     to wait 5 seconds.
+
+    If lazy, the returned Chromecast objects don't connect to their devices
+    until they are used for the first time.
+    """
+    cc_dict = {}
+    for cc in get_chromecasts(tries=tries, retry_wait=retry_wait, lazy=lazy,
+                              **filters):
+        try:
+            cc_dict[cc.device.friendly_name] = cc
+        except ChromecastConnectionError:
+            pass
+    return cc_dict
+
+
+def _get_cached_chromecast(cache, tries=None, retry_wait=None, **filters):
     """
-    return {cc.device.friendly_name: cc
-            for cc in get_chromecasts(tries=tries, retry_wait=retry_wait,
-                                      **filters)}
+    Returns a connected Chromecast for the first cached device which
+    matches the ip and DeviceStatus filters and is reachable, or None.
 
+    The address may have been given to another device since it was
+    cached, so the UUID of the device is checked over DIAL. Devices which
+    don't match are removed from the cache. Cast groups listen on another
+    port of their leader, which answers DIAL with its own UUID, so they
+    are only probed.
 
-def get_chromecast(strict=False, tries=None, retry_wait=None, **filters):
+    The cache is then refreshed by a discovery in the background.
+    """
+    for host in cache.devices:
+        cast = _get_lazy_chromecast(host, tries, retry_wait)
+        if not _matches_device_filters(cast, filters):
+            continue
+
+        if not probe_device(host):
+            continue
+
+        if (host[1] or socket_client.CAST_PORT) == socket_client.CAST_PORT:
+            status = get_device_status(host[0])
+            if status is None or status.uuid != parse_uuid(host[2]):
+                cache.remove(host[2])
+                continue
+
+        try:
+            cast.connect()
+        except ChromecastConnectionError:
+            continue
+
+        refresh = threading.Thread(
+            target=lambda: cache.update(discover_chromecasts()))
+        refresh.daemon = True
+        refresh.start()
+
+        return cast
+
+    return None
+
+
+def _get_first_chromecast(tries=None, retry_wait=None, cache=None,
+                          **filters):
+    """
+    Returns the first discovered Chromecast matching the ip and
+    DeviceStatus filters, or None. Discovery stops as soon as a matching
+    device has been found and connected, other devices aren't connected.
+    """
+    for host in discover_chromecasts_iter():
+        if cache is not None:
+            cache.update([host])
+
+        cast = _get_lazy_chromecast(host, tries, retry_wait)
+        if not _matches_device_filters(cast, filters):
+            continue
+
+        try:
+            cast.connect()
+        except ChromecastConnectionError:
+            continue
+
+        return cast
+
+    return None
+
+
+def get_chromecast(strict=False, tries=None, retry_wait=None, cache=None,
+                   **filters):
     """
     Same as get_chromecasts but only if filter matches exactly one
     ChromeCast.
@@ -124,17 +311,29 @@ def get_chromecast(strict=False, tries=None, retry_wait=None, **filters):
     can be defined by passing the retry_wait parameter, the default is
     to wait 5 seconds.
 
+    If a DeviceCache is given, reachable cached devices are tried before
+    discovering the network, and discovered devices are stored in it.
+
     :type retry_wait: float or None
+    :type cache: DeviceCache or None
     """
 
-    # If we have filters or are operating in strict mode we have to scan
-    # for all Chromecasts to ensure there is only 1 matching chromecast.
-    # If no filters given and not strict just use the first dicsovered one.
-    if filters or strict:
-        results = get_chromecasts(tries=tries, retry_wait=retry_wait,
-                                  **filters)
-    else:
-        results = _get_all_chromecasts(tries, retry_wait)
+    # If we are operating in strict mode or filter on the cast status we
+    # have to scan for all Chromecasts to ensure there is only 1 matching
+    # chromecast. Otherwise just use the first discovered one which
+    # matches the filter.
+    device_keys = set(DeviceStatus._fields) | set(['ip'])
+    if not strict and device_keys.issuperset(filters):
+        if cache is not None:
+            cast = _get_cached_chromecast(cache, tries, retry_wait,
+                                          **filters)
+            if cast is not None:
+                return cast
+
+        return _get_first_chromecast(tries, retry_wait, cache, **filters)
+
+    results = get_chromecasts(tries=tries, retry_wait=retry_wait,
+                              **filters)
 
     if len(results) > 1:
         if strict:
@@ -166,48 +365,110 @@ class Chromecast(object):
     :param retry_wait: A floating point number specifying how many seconds to
                        wait between each retry. None means to use the default
                        which is 5 seconds.
+    :param lazy: If True, the device status is queried and the connection
+                 is opened only when they are used for the first time.
+    :param port: Port of the cast device. None means the default port,
+                 cast groups listen on other ports.
     """
 
-    def __init__(self, host, device=None, tries=None, retry_wait=None):
+    def __init__(self, host, device=None, tries=None, retry_wait=None,
+                 lazy=False, port=None):
         self.logger = logging.getLogger(__name__)
 
         # Resolve host to IP address
         self.host = host
+        self.port = port
+        self.tries = tries
+        self.retry_wait = retry_wait
 
-        self.logger.info("Querying device status")
-        self.device = device or get_device_status(self.host)
-
-        if not self.device:
-            raise ChromecastConnectionError(
-                "Could not connect to {}".format(self.host))
+        self._device = device
+        self._socket_client = None
+        self._lock = threading.Lock()
 
         self.status = None
         self.status_event = threading.Event()
 
-        self.socket_client = socket_client.SocketClient(
-            host, tries, retry_wait=retry_wait)
+        if not lazy:
+            self.connect()
+
+    @property
+    def device(self):
+        """ Returns the device status, querying it on first use. """
+        with self._lock:
+            if self._device is None:
+                self.logger.info("Querying device status")
+                self._device = get_device_status(self.host)
+
+                if not self._device:
+                    raise ChromecastConnectionError(
+                        "Could not connect to {}".format(self.host))
+
+        return self._device
+
+    @property
+    def socket_client(self):
+        """ Returns the socket client, connecting on first use. """
+        with self._lock:
+            if self._socket_client is None:
+                client = socket_client.SocketClient(
+                    self.host, self.tries, retry_wait=self.retry_wait,
+                    port=self.port)
+                client.receiver_controller.register_status_listener(self)
+                client.start()
+                self._socket_client = client
+
+        return self._socket_client
+
+    @property
+    def is_connected(self):
+        """ Returns whether the socket client has been created. """
+        return self._socket_client is not None
+
+    def connect(self):
+        """
+        Queries the device status and connects to the device if this
+        hasn't been done yet.
+
+        Raises ChromecastConnectionError if the device can't be reached.
+        """
+        # pylint: disable=pointless-statement
+        self.device
+        self.socket_client
+
+    def set_volume(self, volume):
+        """ Set the volume level, between 0 and 1. """
+        return self.socket_client.receiver_controller.set_volume(volume)
+
+    def set_volume_muted(self, muted):
+        """ Mute or unmute the device. """
+        return self.socket_client.receiver_controller.set_volume_muted(muted)
+
+    def play_media(self, *args, **kwargs):
+        """ Plays media on the default media receiver app. """
+        return self.media_controller.play_media(*args, **kwargs)
+
+    def register_handler(self, handler):
+        """ Register a new namespace handler. """
+        self.socket_client.register_handler(handler)
 
-        receiver_controller = self.socket_client.receiver_controller
-        receiver_controller.register_status_listener(self)
+    def register_status_listener(self, listener):
+        """ Register a listener for new cast statuses. """
+        self.socket_client.receiver_controller.register_status_listener(
+            listener)
 
-        # Forward these methods
-        self.set_volume = receiver_controller.set_volume
-        self.set_volume_muted = receiver_controller.set_volume_muted
-        self.play_media = self.socket_client.media_controller.play_media
-        self.register_handler = self.socket_client.register_handler
-        self.register_status_listener = \
-            receiver_controller.register_status_listener
-        self.register_launch_error_listener = \
-            receiver_controller.register_launch_error_listener
-        self.register_connection_listener = \
-            self.socket_client.register_connection_listener
+    def register_launch_error_listener(self, listener):
+        """ Register a listener for app launch errors. """
+        self.socket_client.receiver_controller.register_launch_error_listener(
+            listener)
 
-        self.socket_client.start()
+    def register_connection_listener(self, listener):
+        """ Register a listener for connection status changes. """
+        self.socket_client.register_connection_listener(listener)
 
     @property
     def ignore_cec(self):
         """ Returns whether the CEC data should be ignored. """
-        return self.device is not None and \
+        return self._device is not None and \
             any([fnmatch.fnmatchcase(self.device.friendly_name, pattern)
                  for pattern in IGNORE_CEC])
 
@@ -282,6 +543,7 @@ class Chromecast(object):
                         operation in seconds (or fractions thereof). Or None
                         to block forever.
         """
+        self.connect()
         self.status_event.wait(timeout=timeout)
 
     def disconnect(self, timeout=None, blocking=True):
@@ -294,6 +556,8 @@ class Chromecast(object):
         :param blocking: If True it will block until the disconnection is
                          complete, otherwise it will return immediately.
         """
+        if not self.is_connected:
+            return
         self.socket_client.disconnect()
         if blocking:
             self.join(timeout=timeout)
@@ -307,14 +571,16 @@ class Chromecast(object):
                         operation in seconds (or fractions thereof). Or None
                         to block forever.
         """
-        self.socket_client.join(timeout=timeout)
+        if self.is_connected:
+            self.socket_client.join(timeout=timeout)
 
     def __del__(self):
-        self.socket_client.stop.set()
+        if self._socket_client is not None:
+            self._socket_client.stop.set()
 
     def __repr__(self):
         txt = u"Chromecast({!r}, device={!r})".format(
-            self.host, self.device)
+            self.host, self._device)
         # Python 2.x does not work well with unicode returned from repr
         if NON_UNICODE_REPR:
             return txt.encode('utf-8')
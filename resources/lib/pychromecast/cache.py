@@ -0,0 +1,134 @@
+"""
+Persistent cache of discovered Chromecasts, used to find known devices
+without waiting for discovery.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+# Seconds to wait for a cached device to accept a connection
+PROBE_TIMEOUT = 1
+# Entries which haven't been seen for this many seconds are dropped
+MAX_AGE = 30 * 24 * 60 * 60
+# Seconds after which refreshed last seen times are written to the file
+SAVE_INTERVAL = 24 * 60 * 60
+
+
+class DeviceCache(object):
+    """
+    Cache of discovered devices, stored in a JSON file and keyed by
+    device UUID.
+
+    Entries are stored as discovery tuples
+    (ip, port, uuid, model_name, friendly_name) with the time the device
+    was last seen.
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = self._load()
+        # Times at which devices were removed, so they aren't merged back
+        # from the file
+        self._removed = {}
+        self._saved = time.time()
+
+    def _load(self):
+        """ Reads the cache file, returns an empty cache on any error. """
+        try:
+            with open(self.path, "r") as cache_file:
+                entries = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+        now = time.time()
+        return {uuid: entry for uuid, entry in entries.items()
+                if now - entry.get("last_seen", 0) < MAX_AGE}
+
+    def _save(self):
+        """
+        Writes the cache file. Entries which another process (the plugin or
+        the service) has written meanwhile are merged first, the most
+        recently seen entry of a device wins.
+        """
+        self._saved = time.time()
+        for uuid, entry in self._load().items():
+            if entry.get("last_seen", 0) <= self._removed.get(uuid, 0):
+                continue
+            known = self._entries.get(uuid)
+            if known is None or known["last_seen"] < entry["last_seen"]:
+                self._entries[uuid] = entry
+
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as cache_file:
+                json.dump(self._entries, cache_file)
+            try:
+                os.rename(tmp_path, self.path)
+            except OSError:
+                # Windows doesn't rename over an existing file
+                os.remove(self.path)
+                os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            self.logger.exception("Failed to write device cache %s",
+                                  self.path)
+
+    @property
+    def devices(self):
+        """
+        List of tuples (ip, port, uuid, model_name, friendly_name) for each
+        cached device, most recently seen first.
+        """
+        with self._lock:
+            entries = sorted(self._entries.values(),
+                             key=lambda entry: entry["last_seen"],
+                             reverse=True)
+        return [tuple(entry["device"]) for entry in entries]
+
+    def update(self, devices):
+        """
+        Stores discovered devices, given as tuples
+        (ip, port, uuid, model_name, friendly_name). Devices without UUID
+        are ignored.
+        """
+        now = time.time()
+        changed = False
+        with self._lock:
+            for device in devices:
+                uuid = device[2]
+                if not uuid:
+                    continue
+                old_entry = self._entries.get(uuid)
+                self._entries[uuid] = {"device": list(device),
+                                       "last_seen": now}
+                changed = changed or old_entry is None or \
+                    tuple(old_entry["device"]) != tuple(device)
+            # Refreshing last_seen alone isn't worth a write for every
+            # discovery result
+            if changed or now - self._saved > SAVE_INTERVAL:
+                self._save()
+
+    def remove(self, uuid):
+        """ Removes a device from the cache. """
+        with self._lock:
+            self._removed[uuid] = time.time()
+            if self._entries.pop(uuid, None) is not None:
+                self._save()
+
+
+def probe_device(device, timeout=PROBE_TIMEOUT):
+    """
+    Returns whether a cached device, given as a tuple
+    (ip, port, uuid, model_name, friendly_name), accepts connections.
+    """
+    try:
+        sock = socket.create_connection((device[0], device[1] or 8009),
+                                        timeout)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
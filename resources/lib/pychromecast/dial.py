@@ -3,6 +3,7 @@ Implements the DIAL-protocol to communicate with the Chromecast
 """
 import xml.etree.ElementTree as ET
 from collections import namedtuple
+from uuid import UUID
 
 import requests
 import six
@@ -55,14 +56,31 @@ def get_device_status(host):
                                              XML_NS_UPNP_DEVICE, "major", -1)),
                        int(_read_xml_element(api_version_el,
                                              XML_NS_UPNP_DEVICE, "minor", -1)))
+        udn = _read_xml_element(device_info_el, XML_NS_UPNP_DEVICE,
+                                "UDN", None)
 
         return DeviceStatus(friendly_name, model_name, manufacturer,
-                            api_version)
+                            api_version, parse_uuid(udn))
 
     except (requests.exceptions.RequestException, ET.ParseError):
         return None
 
 
+def parse_uuid(value):
+    """
+    Parses device UUID, as found in the UDN element ("uuid:...") or in the
+    "id" field of the mDNS TXT record. Returns None if it can't be parsed.
+    """
+    if not value:
+        return None
+    if value.startswith("uuid:"):
+        value = value[len("uuid:"):]
+    try:
+        return UUID(value)
+    except ValueError:
+        return None
+
+
 def _read_xml_element(element, xml_ns, tag_name, default=""):
     """ Helper method to read text from an element. """
     try:
@@ -78,4 +96,4 @@ def _read_xml_element(element, xml_ns, tag_name, default=""):
 
 DeviceStatus = namedtuple("DeviceStatus",
                           ["friendly_name", "model_name",
-                           "manufacturer", "api_version"])
+                           "manufacturer", "api_version", "uuid"])
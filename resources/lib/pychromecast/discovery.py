@@ -1,15 +1,173 @@
-"""Discovers Chromecasts on the network using mDNS/zeroconf."""
+"""Discovers Chromecasts on the network using mDNS/zeroconf and SSDP."""
+import logging
+import threading
 import time
 
-from zeroconf import ServiceBrowser, Zeroconf
+import six
+from six.moves import queue
+from zeroconf import BROWSING_RECORD_TYPES, ServiceBrowser, Zeroconf
+
+from . import upnp
+from .dial import DeviceStatus, get_device_status, parse_uuid
 
 DISCOVER_TIMEOUT = 5
+CAST_SERVICE_TYPE = "_googlecast._tcp.local."
+ZONE_SERVICE_TYPE = "_googlezone._tcp.local."
+CAST_PORT = 8009
+# The mDNS TXT record carries no DIAL spec version, devices report 1.0
+TXT_API_VERSION = (1, 0)
+# Services found over SSDP are named by this prefix and the ip address
+SSDP_SERVICE_PREFIX = "ssdp:"
+# Seconds between SSDP searches of a running CastBrowser
+SSDP_SEARCH_INTERVAL = 300
+# Number of threads resolving services for a CastListener
+RESOLVE_WORKERS = 4
+# Attempts to resolve a service before it is given up
+RESOLVE_TRIES = 4
+# Seconds a new worker waits for more services to resolve in its batch
+RESOLVE_DELAY = 0.05
+# Seconds the shared Zeroconf stays open after it was released by its last
+# user, so the next discovery starts with its cache
+ZEROCONF_LINGER = 60
+
+_shared_zeroconf = None
+_shared_zeroconf_users = 0
+_shared_zeroconf_timer = None
+_shared_zeroconf_lock = threading.Lock()
+
+
+def _normalize_uuid(value):
+    """ Returns the UUID in the format of the TXT record (hex digits). """
+    uuid = parse_uuid(value)
+    return uuid.hex if uuid else value
+
+
+def get_shared_zeroconf(cache_path=None):
+    """
+    Borrows the Zeroconf instance shared by all discoveries of the process,
+    creating it if needed. Every call has to be matched by a call of
+    release_shared_zeroconf.
+
+    The instance runs in single thread mode and only parses records needed
+    for browsing. If it is created, its cache is loaded from the snapshot
+    at cache_path, which is saved when the instance is closed.
+    """
+    global _shared_zeroconf, _shared_zeroconf_users, _shared_zeroconf_timer
+    with _shared_zeroconf_lock:
+        if _shared_zeroconf_timer is not None:
+            _shared_zeroconf_timer.cancel()
+            _shared_zeroconf_timer = None
+        if _shared_zeroconf is None:
+            _shared_zeroconf = Zeroconf(single_thread=True,
+                                        cache_path=cache_path,
+                                        record_types=BROWSING_RECORD_TYPES)
+        _shared_zeroconf_users += 1
+        return _shared_zeroconf
+
+
+def release_shared_zeroconf(zconf):
+    """
+    Gives back the instance returned by get_shared_zeroconf. It is closed
+    ZEROCONF_LINGER seconds after the last user released it, unless it is
+    borrowed again meanwhile.
+    """
+    global _shared_zeroconf_users, _shared_zeroconf_timer
+    with _shared_zeroconf_lock:
+        if zconf is not _shared_zeroconf or _shared_zeroconf_users <= 0:
+            return
+        _shared_zeroconf_users -= 1
+        if _shared_zeroconf_users == 0:
+            _shared_zeroconf_timer = threading.Timer(ZEROCONF_LINGER,
+                                                     _close_shared_zeroconf)
+            _shared_zeroconf_timer.daemon = True
+            _shared_zeroconf_timer.start()
+
+
+def _close_shared_zeroconf():
+    """ Closes the shared instance, which nobody has borrowed. """
+    global _shared_zeroconf, _shared_zeroconf_timer
+    with _shared_zeroconf_lock:
+        # A timer which was cancelled too late finds another one in place
+        if _shared_zeroconf_timer is not threading.current_thread():
+            return
+        _shared_zeroconf_timer = None
+        zconf, _shared_zeroconf = _shared_zeroconf, None
+    zconf.close()
+
+
+def close_shared_zeroconf():
+    """
+    Closes the shared instance right away instead of letting it linger,
+    e.g. when Kodi shuts down. Users which still hold it are left with a
+    closed instance, their release is ignored.
+    """
+    global _shared_zeroconf, _shared_zeroconf_users, _shared_zeroconf_timer
+    with _shared_zeroconf_lock:
+        if _shared_zeroconf_timer is not None:
+            _shared_zeroconf_timer.cancel()
+            _shared_zeroconf_timer = None
+        zconf, _shared_zeroconf = _shared_zeroconf, None
+        _shared_zeroconf_users = 0
+    if zconf is not None:
+        zconf.close()
+
+
+def _get_txt_value(service, key):
+    """ Retrieve TXT record value of a ServiceInfo and decode it. """
+    value = service.properties.get(key.encode('utf-8'))
+
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, six.binary_type):
+        return value.decode('utf-8')
+    return value
 
 
 class CastListener(object):
-    """Zeroconf Cast Services collection."""
-    def __init__(self):
+    """
+    Zeroconf Cast Services collection.
+
+    add_callback and remove_callback are called with the service name and
+    the service tuple (ip, port, uuid, model_name, friendly_name) whenever
+    a cast device or group appears or disappears. add_callback is called
+    again with the latest tuple when records of a known service change or
+    are refreshed, e.g. when a device gets a new address, so callers can
+    keep their tables up to date. groups_callback is called
+    with the uuid of a cast group and the set of its member uuids when the
+    membership of the group changes.
+
+    Devices are tracked by uuid (and by ip and port): a device seen under
+    several service names, e.g. on two interfaces, is reported once.
+    Devices found over SSDP are dropped if mDNS already knows them, and
+    replaced when mDNS finds them later.
+
+    Services are resolved by up to RESOLVE_WORKERS threads, so add_service
+    returns at once and browsing isn't held up by slow devices. Services
+    queued at the same time are resolved in one batch, and services which
+    disappear while being resolved are dropped.
+    """
+    def __init__(self, add_callback=None, remove_callback=None,
+                 groups_callback=None):
         self.services = {}
+        # Maps group uuid to the set of member uuids
+        self.groups = {}
+        self.add_callback = add_callback
+        self.remove_callback = remove_callback
+        self.groups_callback = groups_callback
+        # Maps duplicate service names to tuples
+        # (name of the reported service, service tuple)
+        self._aliases = {}
+        # Maps zone service names to tuples (member uuid, group uuids)
+        self._zones = {}
+        # Services waiting for resolution, as tuples
+        # (zconf, typ, name, tries)
+        self._pending = []
+        # (typ, name) of services pending or being resolved
+        self._resolving = set()
+        # (typ, name) of services removed while being resolved
+        self._cancelled = set()
+        self._workers = 0
+        self._lock = threading.Lock()
 
     @property
     def count(self):
@@ -18,48 +176,402 @@ class CastListener(object):
 
     @property
     def devices(self):
-        """List of tuples (ip, host) for each discovered device."""
+        """
+        List of tuples (ip, port, uuid, model_name, friendly_name)
+        for each discovered device.
+        """
         return list(self.services.values())
 
+    def _find_duplicate(self, service, exclude=None):
+        """
+        Returns the name of a known service with the same uuid. Services
+        are matched on their address only if one of them has no uuid, as an
+        address may have been handed over to another device.
+        """
+        for name, known in self.services.items():
+            if name == exclude:
+                continue
+            if service[2] is None or known[2] is None:
+                if known[:2] == service[:2]:
+                    return name
+            elif known[2] == service[2]:
+                return name
+        return None
+
     # pylint: disable=unused-argument
     def remove_service(self, zconf, typ, name):
         """ Remove a service from the collection. """
-        self.services.pop(name, None)
+        key = (typ, name)
+        with self._lock:
+            if key in self._resolving:
+                pending = [item for item in self._pending
+                           if item[1:3] != key]
+                if len(pending) < len(self._pending):
+                    self._pending = pending
+                    self._resolving.discard(key)
+                else:
+                    self._cancelled.add(key)
+                return
+
+        if typ == ZONE_SERVICE_TYPE:
+            with self._lock:
+                self._zones.pop(name, None)
+                changed = self._update_groups()
+            self._report_groups(changed)
+            return
+
+        promoted = None
+        with self._lock:
+            if self._aliases.pop(name, None) is not None:
+                return
+
+            service = self.services.pop(name, None)
+            if service is None:
+                return
+
+            # The device may still be reachable under another name
+            aliases = [alias for alias, (primary, _)
+                       in self._aliases.items() if primary == name]
+            if aliases:
+                _, alias_service = self._aliases.pop(aliases[0])
+                self.services[aliases[0]] = alias_service
+                for alias in aliases[1:]:
+                    self._aliases[alias] = (aliases[0],
+                                            self._aliases[alias][1])
+                promoted = (aliases[0], alias_service)
+
+        if self.remove_callback:
+            self.remove_callback(name, service)
+
+        if promoted and self.add_callback:
+            self.add_callback(*promoted)
+
+    def update_service(self, zconf, typ, name):
+        """
+        Resolve a service again, whose records changed or were refreshed.
+        Updates arriving while the service is resolved are merged.
+        """
+        self.add_service(zconf, typ, name)
 
     def add_service(self, zconf, typ, name):
-        """ Add a service to the collection. """
-        service = None
-        tries = 0
-        while service is None and tries < 4:
-            service = zconf.get_service_info(typ, name)
-            tries += 1
+        """ Queue a service for resolution and adding to the collection. """
+        key = (typ, name)
+        with self._lock:
+            self._cancelled.discard(key)
+            if key in self._resolving:
+                return
+            self._resolving.add(key)
+            self._pending.append((zconf, typ, name, 0))
+            start_worker = self._workers < RESOLVE_WORKERS
+            if start_worker:
+                self._workers += 1
+
+        if start_worker:
+            worker = threading.Thread(target=self._resolve_pending)
+            worker.daemon = True
+            worker.start()
+
+    def _resolve_pending(self):
+        """ Resolves queued services in batches until none are left. """
+        # Services are often found in bursts, one per answer of a packet
+        time.sleep(RESOLVE_DELAY)
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._workers -= 1
+                    return
+                # Take all services queued for the same zeroconf and type
+                zconf, typ = self._pending[0][:2]
+                batch = [item for item in self._pending
+                         if item[0] is zconf and item[1] == typ]
+                self._pending = [item for item in self._pending
+                                 if item[0] is not zconf or item[1] != typ]
+
+            tries = dict((item[2], item[3]) for item in batch)
+
+            def resolved(name, service):
+                """ Adds a service without waiting for the batch. """
+                self._resolved(zconf, typ, name, tries.pop(name), service)
+
+            try:
+                zconf.get_service_infos(typ, list(tries), callback=resolved)
+            except Exception:  # pylint: disable=broad-except
+                logging.getLogger(__name__).exception(
+                    "Failed to resolve services of %s", typ)
+
+            # Services which didn't answer are tried again
+            for name, count in list(tries.items()):
+                self._resolved(zconf, typ, name, count, None)
+
+    def _resolved(self, zconf, typ, name, tries, service):
+        """ Adds a resolved service, unless it was removed meanwhile. """
+        key = (typ, name)
+        with self._lock:
+            if key in self._cancelled:
+                self._cancelled.discard(key)
+                self._resolving.discard(key)
+                return
+            if service is None:
+                if tries + 1 < RESOLVE_TRIES:
+                    self._pending.append((zconf, typ, name, tries + 1))
+                else:
+                    self._resolving.discard(key)
+                return
+
+        if typ == ZONE_SERVICE_TYPE:
+            self._add_zone(name, service)
+        else:
+            self._add_cast(zconf, name, service)
+
+        with self._lock:
+            self._resolving.discard(key)
+            removed = key in self._cancelled
+            self._cancelled.discard(key)
+        if removed:
+            self.remove_service(zconf, typ, name)
+
+    def _add_cast(self, zconf, name, service):
+        """ Add a resolved cast service to the collection. """
+        ips = zconf.cache.entries_with_name(service.server.lower())
+        # The latest address, the old one lingers until it expires
+        host = repr(max(ips, key=lambda ip: ip.created)) if ips \
+            else service.server
 
-        if service:
-            ips = zconf.cache.entries_with_name(service.server.lower())
-            host = repr(ips[0]) if ips else service.server
+        service = (host, service.port,
+                   _normalize_uuid(_get_txt_value(service, 'id')),
+                   _get_txt_value(service, 'md'),
+                   _get_txt_value(service, 'fn'))
+        replaced = None
 
-            self.services[name] = (host, service.port)
+        with self._lock:
+            duplicate = self._find_duplicate(service, exclude=name)
+            if duplicate is not None and \
+                    duplicate.startswith(SSDP_SERVICE_PREFIX):
+                replaced = (duplicate, self.services.pop(duplicate))
+                self.services[name] = service
+            elif duplicate is not None:
+                # Same device under another service name, update the
+                # reported one with the latest address
+                self._aliases[name] = (duplicate, service)
+                self.services[duplicate] = service
+                name = duplicate
+            else:
+                self.services[name] = service
+
+        if replaced and self.remove_callback:
+            self.remove_callback(*replaced)
+
+        if self.add_callback:
+            self.add_callback(name, service)
+
+    def add_ssdp_device(self, host, uuid):
+        """
+        Add a device found over SSDP to the collection. SSDP answers don't
+        carry device names, so they are queried over DIAL.
+        """
+        service = (host, CAST_PORT, _normalize_uuid(uuid), None, None)
+
+        with self._lock:
+            if self._find_duplicate(service) is not None:
+                return
+
+        device = get_device_status(host)
+        if device:
+            service = (host, CAST_PORT,
+                       service[2] or (device.uuid and device.uuid.hex),
+                       device.model_name, device.friendly_name)
+
+        name = SSDP_SERVICE_PREFIX + host
+        with self._lock:
+            if self._find_duplicate(service) is not None:
+                return
+            self.services[name] = service
+
+        if self.add_callback:
+            self.add_callback(name, service)
+
+    def _add_zone(self, name, service):
+        """
+        Record group membership of a speaker. Every speaker advertises
+        a zone service, whose TXT record holds the speaker uuid ("id") and
+        the uuids of the groups it is a member of.
+        """
+        member = _normalize_uuid(_get_txt_value(service, 'id'))
+        group_uuids = set()
+        for key in service.properties:
+            if isinstance(key, six.binary_type):
+                key = key.decode('utf-8', 'replace')
+            group_uuid = parse_uuid(key)
+            if group_uuid and group_uuid.hex != member:
+                group_uuids.add(group_uuid.hex)
+
+        with self._lock:
+            self._zones[name] = (member, group_uuids)
+            changed = self._update_groups()
+        self._report_groups(changed)
+
+    def _update_groups(self):
+        """
+        Rebuilds group membership from zone services.
+        Returns the groups whose membership changed.
+        """
+        groups = {}
+        for member, group_uuids in self._zones.values():
+            for group_uuid in group_uuids:
+                groups.setdefault(group_uuid, set()).add(member)
+
+        changed = {group_uuid: groups.get(group_uuid, set())
+                   for group_uuid in set(groups) | set(self.groups)
+                   if groups.get(group_uuid) != self.groups.get(group_uuid)}
+        self.groups = groups
+        return changed
+
+    def _report_groups(self, changed):
+        """ Calls groups_callback for every changed group. """
+        if self.groups_callback:
+            for group_uuid, members in changed.items():
+                self.groups_callback(group_uuid, members)
+
+
+class CastBrowser(object):
+    """
+    Discovers cast devices over mDNS and SSDP at the same time and reports
+    them to one CastListener, whichever protocol answers first.
+
+    Some networks drop multicast DNS but pass SSDP, or the other way
+    round. SSDP is searched again every SSDP_SEARCH_INTERVAL seconds.
+
+    Zone services are browsed as well, so the listener knows the members
+    of cast groups.
+
+    The browsers use the shared Zeroconf instance, so services which were
+    found by an earlier discovery are reported from its cache. With
+    cache_path, the cache is also kept in a snapshot file over restarts.
+    """
+    def __init__(self, listener, ssdp=True, cache_path=None):
+        self.listener = listener
+        self.stop = threading.Event()
+        self.cache_path = cache_path
+        self.zc = get_shared_zeroconf(cache_path)
+        self.mdns_browser = ServiceBrowser(self.zc, CAST_SERVICE_TYPE,
+                                           listener, resolve=True)
+        self.zone_browser = ServiceBrowser(self.zc, ZONE_SERVICE_TYPE,
+                                           listener, resolve=True)
+
+        if ssdp:
+            ssdp_thread = threading.Thread(target=self._run_ssdp)
+            ssdp_thread.daemon = True
+            ssdp_thread.start()
+
+    def _run_ssdp(self):
+        """ Repeats SSDP searches until the browser is cancelled. """
+        while not self.stop.is_set():
+            upnp.discover_chromecasts(callback=self._ssdp_device_found,
+                                      stop=self.stop)
+            self.stop.wait(SSDP_SEARCH_INTERVAL)
+
+    def _ssdp_device_found(self, host, uuid):
+        """ Adds a device found over SSDP without blocking the search. """
+        worker = threading.Thread(target=self.listener.add_ssdp_device,
+                                  args=(host, uuid))
+        worker.daemon = True
+        worker.start()
+
+    def cancel(self):
+        """ Stops both discoveries. """
+        self.stop.set()
+        self.mdns_browser.cancel()
+        self.zone_browser.cancel()
+        if self.cache_path is not None:
+            # The shared instance may be closed too late to be saved
+            self.zc.save_cache(self.cache_path)
+        release_shared_zeroconf(self.zc)
+
+
+def get_device_status_from_service(service):
+    """
+    Returns the device status of a discovered device, built from its
+    mDNS TXT record, or None if the TXT record has no friendly name.
+    Chromecast objects without a device status query it over DIAL.
+
+    :param service: tuple (ip, port, uuid, model_name, friendly_name)
+    """
+    _, _, uuid, model_name, friendly_name = service
+
+    if not friendly_name:
+        return None
+
+    return DeviceStatus(friendly_name, model_name or "Unknown model name",
+                        "Unknown manufacturer", TXT_API_VERSION,
+                        parse_uuid(uuid))
+
+
+def start_discovery(listener, ssdp=True, cache_path=None):
+    """
+    Start discovering chromecasts on the network in the background,
+    over mDNS and, if ssdp is True, over SSDP.
+
+    Discovered services are reported to the given CastListener until the
+    returned browser is passed to stop_discovery. If cache_path is given,
+    the mDNS cache is saved there on stop and loaded on the next start.
+    """
+    return CastBrowser(listener, ssdp, cache_path)
+
+
+def stop_discovery(browser):
+    """ Stop discovery started with start_discovery. """
+    browser.cancel()
 
 
 def discover_chromecasts(max_devices=None, timeout=DISCOVER_TIMEOUT):
     """ Discover chromecasts on the network. """
+    discover_complete = threading.Event()
+
+    # pylint: disable=unused-argument
+    def callback(name, service):
+        """Called when zeroconf has discovered a new chromecast."""
+        if max_devices is not None and listener.count >= max_devices:
+            discover_complete.set()
+
+    listener = CastListener(callback)
+    browser = start_discovery(listener)
     try:
-        zconf = Zeroconf()
-        listener = CastListener()
-        browser = ServiceBrowser(zconf, "_googlecast._tcp.local.", listener)
+        # Wait for the timeout or the maximum number of devices
+        discover_complete.wait(timeout)
 
-        if max_devices is None:
-            time.sleep(timeout)
-            return listener.devices
+        return listener.devices
+    finally:
+        stop_discovery(browser)
 
-        else:
-            start = time.time()
 
-            while (time.time() - start < timeout and
-                   listener.count < max_devices):
-                time.sleep(.1)
+def discover_chromecasts_iter(timeout=DISCOVER_TIMEOUT):
+    """
+    Discover chromecasts on the network, yielding the tuple
+    (ip, port, uuid, model_name, friendly_name) of each device as soon as
+    it is resolved. Discovery stops after timeout seconds or when the
+    generator is closed.
+    """
+    found = queue.Queue()
+    names = set()
+
+    def callback(name, service):
+        """Called when zeroconf has discovered a new chromecast."""
+        # Refreshed services are reported again under the same name
+        if name not in names:
+            names.add(name)
+            found.put(service)
 
-            return listener.devices
+    browser = start_discovery(CastListener(callback))
+    try:
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            try:
+                service = found.get(timeout=remaining)
+            except queue.Empty:
+                return
+            yield service
     finally:
-        browser.cancel()
-        zconf.close()
+        stop_discovery(browser)
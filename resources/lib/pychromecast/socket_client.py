@@ -68,6 +68,7 @@ HB_PONG_TIME = 10
 POLL_TIME = 5
 TIMEOUT_TIME = 30
 RETRY_TIME = 5
+CAST_PORT = 8009
 
 
 class InterruptLoop(Exception):
@@ -131,9 +132,11 @@ class SocketClient(threading.Thread):
     :param retry_wait: A floating point number specifying how many seconds to
                        wait between each retry. None means to use the default
                        which is 5 seconds.
+    :param port: Port of the cast device. None means the default port 8009,
+                 cast groups listen on other ports.
     """
 
-    def __init__(self, host, tries=None, retry_wait=None):
+    def __init__(self, host, tries=None, retry_wait=None, port=None):
         super(SocketClient, self).__init__()
 
         self.daemon = True
@@ -145,6 +148,7 @@ class SocketClient(threading.Thread):
         self.tries = tries
         self.retry_wait = retry_wait or RETRY_TIME
         self.host = host
+        self.port = port or CAST_PORT
 
         self.source_id = "sender-0"
         self.stop = threading.Event()
@@ -210,13 +214,13 @@ class SocketClient(threading.Thread):
                 self.socket.settimeout(TIMEOUT_TIME)
                 self._report_connection_status(
                     ConnectionStatus(CONNECTION_STATUS_CONNECTING,
-                                     (self.host, 8009)))
-                self.socket.connect((self.host, 8009))
+                                     (self.host, self.port)))
+                self.socket.connect((self.host, self.port))
                 self.connecting = False
                 self._force_recon = False
                 self._report_connection_status(
                     ConnectionStatus(CONNECTION_STATUS_CONNECTED,
-                                     (self.host, 8009)))
+                                     (self.host, self.port)))
                 self.receiver_controller.update_status()
                 self.heartbeat_controller.ping()
                 self.heartbeat_controller.reset()
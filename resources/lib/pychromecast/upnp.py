@@ -4,7 +4,7 @@ Module that implements UPNP protocol to discover Chromecasts
 import select
 import socket
 import logging
-import datetime as dt
+import time
 
 # pylint: disable=import-error
 try:  # Python 2
@@ -18,6 +18,11 @@ SSDP_ADDR = "239.255.255.250"
 SSDP_PORT = 1900
 SSDP_MX = 1
 SSDP_ST = "urn:dial-multiscreen-org:service:dial:1"
+# M-SEARCH is sent over UDP, so it is retransmitted in case it gets lost
+SSDP_RETRIES = 3
+SSDP_RETRY_INTERVAL = 1
+# Seconds between checks whether discovery has been stopped
+STOP_POLL_TIME = 0.5
 
 SSDP_REQUEST = 'M-SEARCH * HTTP/1.1\r\n' + \
                'HOST: {}:{:d}\r\n'.format(SSDP_ADDR, SSDP_PORT) + \
@@ -27,42 +32,66 @@ SSDP_REQUEST = 'M-SEARCH * HTTP/1.1\r\n' + \
                '\r\n'
 
 
-# pylint: disable=too-many-locals, too-many-branches
-def discover_chromecasts(max_devices=None, timeout=DISCOVER_TIMEOUT):
+def _parse_uuid(usn):
+    """ Returns the UUID part of an USN header ("uuid:...::urn:..."). """
+    if not usn.startswith("uuid:"):
+        return None
+    return usn[len("uuid:"):].split("::", 1)[0]
+
+
+# pylint: disable=too-many-locals, too-many-branches, too-many-statements
+def discover_chromecasts(max_devices=None, timeout=DISCOVER_TIMEOUT,
+                         callback=None, stop=None):
     """
     Sends a message over the network to discover Chromecasts and returns
     a list of found IP addresses.
 
+    The message is sent SSDP_RETRIES times, SSDP_RETRY_INTERVAL seconds
+    apart. If callback is given, it is called with the IP address and the
+    UUID (or None) of every device as soon as it answers. Discovery ends
+    after timeout seconds, or when the stop event is set.
+
     Inspired by Crimsdings
     https://github.com/crimsdings/ChromeCast/blob/master/cc_discovery.py
     """
     ips = []
 
-    calc_now = dt.datetime.now
-    start = calc_now()
+    start = time.time()
+    next_search = start
+    searches = 0
+    sock = None
 
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-        sock.sendto(SSDP_REQUEST.encode("ascii"), (SSDP_ADDR, SSDP_PORT))
-
         sock.setblocking(0)
 
-        while True:
-            time_diff = calc_now() - start
+        while stop is None or not stop.is_set():
+            now = time.time()
 
-            # pylint: disable=maybe-no-member
-            seconds_left = timeout - time_diff.seconds
+            seconds_left = timeout - (now - start)
 
             if seconds_left <= 0:
                 return ips
 
-            ready = select.select([sock], [], [], seconds_left)[0]
+            if searches < SSDP_RETRIES and now >= next_search:
+                sock.sendto(SSDP_REQUEST.encode("ascii"),
+                            (SSDP_ADDR, SSDP_PORT))
+                searches += 1
+                next_search = now + SSDP_RETRY_INTERVAL
+
+            wait = seconds_left
+            if searches < SSDP_RETRIES:
+                wait = min(wait, next_search - now)
+            if stop is not None:
+                wait = min(wait, STOP_POLL_TIME)
+
+            ready = select.select([sock], [], [], max(wait, 0))[0]
 
             if ready:
                 response = sock.recv(1024).decode("ascii")
 
-                found_ip = found_st = None
+                found_ip = found_st = found_uuid = None
 
                 headers = response.split("\r\n\r\n", 1)[0]
 
@@ -75,6 +104,7 @@ def discover_chromecasts(max_devices=None, timeout=DISCOVER_TIMEOUT):
                         continue
 
                     key, value = parts
+                    key = key.upper()
 
                     if key == "LOCATION":
                         url = urlparse.urlparse(value)
@@ -84,9 +114,16 @@ def discover_chromecasts(max_devices=None, timeout=DISCOVER_TIMEOUT):
                     elif key == "ST":
                         found_st = value
 
-                if found_st == SSDP_ST and found_ip:
+                    elif key == "USN":
+                        found_uuid = _parse_uuid(value)
+
+                # Every retransmitted search is answered again
+                if found_st == SSDP_ST and found_ip and found_ip not in ips:
                     ips.append(found_ip)
 
+                    if callback:
+                        callback(found_ip, found_uuid)
+
                     if max_devices and len(ips) == max_devices:
                         return ips
 
@@ -95,6 +132,7 @@ def discover_chromecasts(max_devices=None, timeout=DISCOVER_TIMEOUT):
             "Socket error while discovering Chromecasts")
 
     finally:
-        sock.close()
+        if sock is not None:
+            sock.close()
 
     return ips
@@ -0,0 +1,107 @@
+# select_dialog.py - implementation of cast device selection dialog
+#
+# Copyright 2016 kharts (https://github.com/kharts)
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+
+import threading
+import xbmcgui
+import pyxbmct
+from common import *
+
+
+WINDOW_WIDTH = 480
+WINDOW_HEIGHT = 400
+NUM_ROWS = 8
+NUM_COLUMNS = 4
+
+
+class SelectCastDialog(pyxbmct.AddonDialogWindow):
+    """
+    Dialog for selecting cast device. Devices can be added while
+    the dialog is shown, so user is able to select device before
+    discovery is finished.
+
+    :param title: text for window header
+    :type title: str
+    """
+
+    def __init__(self, title="Cast to"):
+        """
+        :param title: text for window header
+        :type title: str
+        """
+
+        super(SelectCastDialog, self).__init__(title)
+        self.setGeometry(WINDOW_WIDTH, WINDOW_HEIGHT, NUM_ROWS, NUM_COLUMNS)
+        self.status_label = pyxbmct.Label("Discovering cast devices...")
+        self.placeControl(self.status_label,
+                          row=0,
+                          column=0,
+                          rowspan=1,
+                          columnspan=NUM_COLUMNS)
+        self.cast_list = pyxbmct.List()
+        self.placeControl(self.cast_list,
+                          row=1,
+                          column=0,
+                          rowspan=NUM_ROWS - 1,
+                          columnspan=NUM_COLUMNS)
+        self.connect(self.cast_list, self.cast_selected)
+        self.casts = []
+        self.selected = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def add_cast(self, name, cast, description=""):
+        """
+        Add cast device to the list
+        :param name: friendly name of the device
+        :type name: str
+        :param cast: cast device, or None if the device should be
+            looked up by name
+        :type cast: pychromecast.Chromecast
+        :param description: second line of the list item
+            (members of cast group)
+        :type description: str
+        :return: None
+        """
+
+        with self.lock:
+            self.casts.append((name, cast))
+            self.cast_list.addItem(xbmcgui.ListItem(name, description))
+            if len(self.casts) == 1:
+                self.setFocus(self.cast_list)
+
+    def discovery_finished(self):
+        """
+        Update status text when no more devices are expected
+        :return: None
+        """
+
+        if self.casts:
+            self.status_label.setLabel("Select cast device")
+        else:
+            self.status_label.setLabel("No cast devices found")
+
+    def cast_selected(self):
+        """
+        cast_list item selection handler
+        :return: None
+        """
+
+        index = self.cast_list.getSelectedPosition()
+        with self.lock:
+            if 0 <= index < len(self.casts):
+                self.selected = self.casts[index]
+        self.close()
+
+    def close(self):
+        """
+        Close the dialog
+        :return: None
+        """
+
+        self.closed = True
+        super(SelectCastDialog, self).close()
@@ -24,17 +24,23 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import enum
 import errno
+import hashlib
+import heapq
+import itertools
 import logging
+import os
+import random
 import select
 import socket
 import struct
+import sys
 import threading
 import time
-from functools import reduce
+from collections import OrderedDict, deque
 
 import netifaces
 from six import binary_type, indexbytes, int2byte, iteritems, text_type
-from six.moves import xrange
+from six.moves import queue, xrange
 
 __author__ = 'Paul Scott-Murphy, William McBrine'
 __maintainer__ = 'Jakub Stasiak <jakub@stasiak.at>'
@@ -55,6 +61,7 @@ __all__ = [
     "__version__",
     "Zeroconf", "ServiceInfo", "ServiceBrowser",
     "Error", "InterfaceChoice", "ServiceStateChange",
+    "BROWSING_RECORD_TYPES",
 ]
 
 
@@ -64,10 +71,6 @@ log.addHandler(NullHandler())
 if log.level == logging.NOTSET:
     log.setLevel(logging.WARN)
 
-# hook for threads
-
-_GLOBAL_DONE = False
-
 # Some timing constants
 
 _UNREGISTER_TIME = 125
@@ -75,17 +78,76 @@ _CHECK_TIME = 175
 _REGISTER_TIME = 225
 _LISTENER_TIME = 200
 _BROWSER_TIME = 500
+# Services found within this time are resolved with the same query
+_RESOLVE_TIME = 100
+
+# Records of interest are queried again at these percentages of their TTL,
+# plus a random jitter of up to _REFRESH_JITTER percent (RFC 6762, 5.2)
+
+_REFRESH_PERCENTS = (80, 85, 90, 95)
+_REFRESH_JITTER = 2
+
+# Default number of records kept in the cache, and a rough estimate of the
+# memory taken by a record in the cache, besides its name and data
+
+_CACHE_RECORDS = 1000
+_RECORD_SIZE = 400
+# Estimated memory taken by an entry of the expiration heap
+_EXPIRATION_SIZE = 80
+# Entries of removed records are dropped from the expiration heap, when it
+# holds this many more than twice the number of cached records
+_EXPIRATION_SLACK = 64
+# Recently used records searched for one which nobody is interested in,
+# before the least recently used one is evicted
+_EVICTION_SCAN = 32
+
+# Records loaded from a cache snapshot expire, unless they are confirmed
+# by an answer within this time
+
+_CONFIRM_TIME = 10 * 1000
+
+# Addresses of the interfaces are enumerated again when they are older than
+# this, and an instance using all interfaces looks for changes this often
+
+_ADDRESS_CACHE_TIME = 5 * 1000
+_INTERFACE_CHECK_TIME = 10 * 1000
+
+# Packets equal to one received within this time are dropped unparsed,
+# and at most this many recent packets are remembered
+
+_DUPLICATE_TIME = 1000
+_DUPLICATE_PACKETS = 256
+
+# Packets of a source beyond this rate per second, after a burst of this
+# many, are dropped, and at most this many sources are tracked
+
+_SOURCE_RATE = 50
+_SOURCE_BURST = 100
+_SOURCE_ENTRIES = 256
+
+# A cache snapshot starts with the magic and the time it was saved at,
+# followed by packets of cached records, each prefixed by its length
+
+_SNAPSHOT_MAGIC = b'ZCS1'
+_SNAPSHOT_HEADER = struct.Struct(b'!4sQ')
+_SNAPSHOT_RECORDS = 32
 
 # Some DNS constants
 
 _MDNS_ADDR = '224.0.0.251'
+# Linux delivers multicast packets to every socket bound to the port,
+# unless this option (missing in the socket module of Python 2) is cleared
+_IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)
 _MDNS_PORT = 5353
 _DNS_PORT = 53
 _DNS_TTL = 60 * 60  # one hour default TTL
 
-_MAX_MSG_TYPICAL = 1460  # unused
+_MAX_MSG_TYPICAL = 1460
 _MAX_MSG_ABSOLUTE = 8972
 
+_SHORT = struct.Struct(b'!H')
+_INT = struct.Struct(b'!I')
+
 _FLAGS_QR_MASK = 0x8000  # query response mask
 _FLAGS_QR_QUERY = 0x0000  # query
 _FLAGS_QR_RESPONSE = 0x8000  # response
@@ -128,6 +190,10 @@ _TYPE_AAAA = 28
 _TYPE_SRV = 33
 _TYPE_ANY = 255
 
+# Record types which browsing and resolving services need, for
+# Zeroconf.record_types
+BROWSING_RECORD_TYPES = frozenset((_TYPE_A, _TYPE_PTR, _TYPE_SRV, _TYPE_TXT))
+
 # Mapping constants to names
 
 _CLASSES = {_CLASS_IN: "in",
@@ -171,6 +237,10 @@ class Error(Exception):
     pass
 
 
+class IncomingDecodeError(Error):
+    pass
+
+
 class NonLocalNameException(Exception):
     pass
 
@@ -192,14 +262,33 @@ class BadTypeInNameException(Exception):
 
 # implementation classes
 
+# Names of records are interned, so records with the same name share it
+_MAX_INTERNED = 4096
+_interned = {}
+
+
+def intern_name(name):
+    """Returns the interned copy of a name.  The builtin intern() doesn't
+    take unicode on Python 2."""
+    try:
+        return _interned[name]
+    except KeyError:
+        if len(_interned) >= _MAX_INTERNED:
+            # Names of devices which are gone pile up, start over
+            _interned.clear()
+        _interned[name] = name
+        return name
+
 
 class DNSEntry(object):
 
     """A DNS entry"""
 
+    __slots__ = ('key', 'name', 'type', 'class_', 'unique')
+
     def __init__(self, name, type, class_):
-        self.key = name.lower()
-        self.name = name
+        self.key = intern_name(name.lower())
+        self.name = intern_name(name)
         self.type = type
         self.class_ = class_ & _CLASS_MASK
         self.unique = (class_ & _CLASS_UNIQUE) != 0
@@ -215,6 +304,10 @@ class DNSEntry(object):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    def __hash__(self):
+        """Hash on name, type and class, consistent with equality"""
+        return hash((self.key, self.type, self.class_))
+
     def get_class_(self, class_):
         """Class accessor"""
         return _CLASSES.get(class_, "?(%s)" % class_)
@@ -243,6 +336,8 @@ class DNSQuestion(DNSEntry):
 
     """A DNS question entry"""
 
+    __slots__ = ()
+
     def __init__(self, name, type, class_):
         # if not name.endswith(".local."):
         #    raise NonLocalNameException
@@ -263,6 +358,8 @@ class DNSRecord(DNSEntry):
 
     """A DNS record - like a DNS entry, but has a TTL"""
 
+    __slots__ = ('ttl', 'created')
+
     def __init__(self, name, type, class_, ttl):
         DNSEntry.__init__(self, name, type, class_)
         self.ttl = ttl
@@ -272,6 +369,8 @@ class DNSRecord(DNSEntry):
         """Tests equality as per DNSRecord"""
         return isinstance(other, DNSRecord) and DNSEntry.__eq__(self, other)
 
+    __hash__ = DNSEntry.__hash__
+
     def suppressed_by(self, msg):
         """Returns true if any answer in a message can suffice for the
         information held in this record."""
@@ -312,6 +411,10 @@ class DNSRecord(DNSEntry):
         """Abstract method"""
         raise AbstractMethodException
 
+    def size(self):
+        """Returns estimated memory taken by this record in a cache"""
+        return _RECORD_SIZE + len(self.name)
+
     def to_string(self, other):
         """String representation with addtional information"""
         arg = "%s/%s,%s" % (self.ttl,
@@ -323,6 +426,8 @@ class DNSAddress(DNSRecord):
 
     """A DNS address record"""
 
+    __slots__ = ('address',)
+
     def __init__(self, name, type, class_, ttl, address):
         DNSRecord.__init__(self, name, type, class_, ttl)
         self.address = address
@@ -331,9 +436,18 @@ class DNSAddress(DNSRecord):
         """Used in constructing an outgoing packet"""
         out.write_string(self.address)
 
+    def size(self):
+        return DNSRecord.size(self) + len(self.address)
+
     def __eq__(self, other):
         """Tests equality on address"""
-        return isinstance(other, DNSAddress) and self.address == other.address
+        return (isinstance(other, DNSAddress) and
+                self.address == other.address and
+                DNSRecord.__eq__(self, other))
+
+    def __hash__(self):
+        """Hash consistent with equality"""
+        return hash((self.key, self.type, self.class_, self.address))
 
     def __repr__(self):
         """String representation"""
@@ -348,6 +462,8 @@ class DNSHinfo(DNSRecord):
 
     """A DNS host information record"""
 
+    __slots__ = ('cpu', 'os')
+
     def __init__(self, name, type, class_, ttl, cpu, os):
         DNSRecord.__init__(self, name, type, class_, ttl)
         self.cpu = cpu
@@ -358,10 +474,18 @@ class DNSHinfo(DNSRecord):
         out.write_string(self.cpu)
         out.write_string(self.oso)
 
+    def size(self):
+        return DNSRecord.size(self) + len(self.cpu) + len(self.os)
+
     def __eq__(self, other):
         """Tests equality on cpu and os"""
         return (isinstance(other, DNSHinfo) and
-                self.cpu == other.cpu and self.os == other.os)
+                self.cpu == other.cpu and self.os == other.os and
+                DNSRecord.__eq__(self, other))
+
+    def __hash__(self):
+        """Hash consistent with equality"""
+        return hash((self.key, self.type, self.class_, self.cpu, self.os))
 
     def __repr__(self):
         """String representation"""
@@ -372,17 +496,28 @@ class DNSPointer(DNSRecord):
 
     """A DNS pointer record"""
 
+    __slots__ = ('alias',)
+
     def __init__(self, name, type, class_, ttl, alias):
         DNSRecord.__init__(self, name, type, class_, ttl)
-        self.alias = alias
+        self.alias = intern_name(alias)
 
     def write(self, out):
         """Used in constructing an outgoing packet"""
         out.write_name(self.alias)
 
+    def size(self):
+        return DNSRecord.size(self) + len(self.alias)
+
     def __eq__(self, other):
         """Tests equality on alias"""
-        return isinstance(other, DNSPointer) and self.alias == other.alias
+        return (isinstance(other, DNSPointer) and
+                self.alias == other.alias and
+                DNSRecord.__eq__(self, other))
+
+    def __hash__(self):
+        """Hash consistent with equality"""
+        return hash((self.key, self.type, self.class_, self.alias))
 
     def __repr__(self):
         """String representation"""
@@ -393,6 +528,8 @@ class DNSText(DNSRecord):
 
     """A DNS text record"""
 
+    __slots__ = ('text',)
+
     def __init__(self, name, type_, class_, ttl, text):
         assert isinstance(text, (bytes, type(None)))
         DNSRecord.__init__(self, name, type_, class_, ttl)
@@ -402,9 +539,18 @@ class DNSText(DNSRecord):
         """Used in constructing an outgoing packet"""
         out.write_string(self.text)
 
+    def size(self):
+        return DNSRecord.size(self) + len(self.text or b'')
+
     def __eq__(self, other):
         """Tests equality on text"""
-        return isinstance(other, DNSText) and self.text == other.text
+        return (isinstance(other, DNSText) and
+                self.text == other.text and
+                DNSRecord.__eq__(self, other))
+
+    def __hash__(self):
+        """Hash consistent with equality"""
+        return hash((self.key, self.type, self.class_, self.text))
 
     def __repr__(self):
         """String representation"""
@@ -418,12 +564,14 @@ class DNSService(DNSRecord):
 
     """A DNS service record"""
 
+    __slots__ = ('priority', 'weight', 'port', 'server')
+
     def __init__(self, name, type, class_, ttl, priority, weight, port, server):
         DNSRecord.__init__(self, name, type, class_, ttl)
         self.priority = priority
         self.weight = weight
         self.port = port
-        self.server = server
+        self.server = intern_name(server)
 
     def write(self, out):
         """Used in constructing an outgoing packet"""
@@ -432,13 +580,22 @@ class DNSService(DNSRecord):
         out.write_short(self.port)
         out.write_name(self.server)
 
+    def size(self):
+        return DNSRecord.size(self) + len(self.server)
+
     def __eq__(self, other):
         """Tests equality on priority, weight, port and server"""
         return (isinstance(other, DNSService) and
                 self.priority == other.priority and
                 self.weight == other.weight and
                 self.port == other.port and
-                self.server == other.server)
+                self.server == other.server and
+                DNSRecord.__eq__(self, other))
+
+    def __hash__(self):
+        """Hash consistent with equality"""
+        return hash((self.key, self.type, self.class_, self.priority,
+                     self.weight, self.port, self.server))
 
     def __repr__(self):
         """String representation"""
@@ -447,39 +604,49 @@ class DNSService(DNSRecord):
 
 class DNSIncoming(object):
 
-    """Object representation of an incoming DNS packet"""
+    """Object representation of an incoming DNS packet
+
+    Fields are unpacked in place with struct.unpack_from, and names are
+    decoded once per packet offset, so compressed names pointing to the
+    same suffix reuse it.  If types is given, records of other types are
+    skipped without being decoded."""
 
-    def __init__(self, data):
+    def __init__(self, data, types=None):
         """Constructor from string holding bytes of packet"""
         self.offset = 0
         self.data = data
+        self.types = types
         self.questions = []
         self.answers = []
         self.num_questions = 0
         self.num_answers = 0
         self.num_authorities = 0
         self.num_additionals = 0
+        # Maps offset of a name to (name, offset following it)
+        self.names = {}
 
         self.read_header()
         self.read_questions()
         self.read_others()
 
     def unpack(self, format):
-        length = struct.calcsize(format)
-        info = struct.unpack(format, self.data[self.offset:self.offset + length])
-        self.offset += length
+        info = struct.unpack_from(format, self.data, self.offset)
+        self.offset += struct.calcsize(format)
         return info
 
     def read_header(self):
         """Reads header portion of packet"""
         (self.id, self.flags, self.num_questions, self.num_answers,
-         self.num_quthorities, self.num_additionals) = self.unpack(b'!6H')
+         self.num_authorities, self.num_additionals) = \
+            struct.unpack_from(b'!6H', self.data, 0)
+        self.offset = 12
 
     def read_questions(self):
         """Reads questions section of packet"""
         for i in xrange(self.num_questions):
             name = self.read_name()
-            type, class_ = self.unpack(b'!HH')
+            type, class_ = struct.unpack_from(b'!HH', self.data, self.offset)
+            self.offset += 4
 
             question = DNSQuestion(name, type, class_)
             self.questions.append(question)
@@ -508,31 +675,39 @@ class DNSIncoming(object):
         """Reads the answers, authorities and additionals section of the
         packet"""
         n = self.num_answers + self.num_authorities + self.num_additionals
+        data = self.data
+        types = self.types
         for i in xrange(n):
             domain = self.read_name()
-            type, class_, ttl, length = self.unpack(b'!HHiH')
+            type, class_, ttl, length = struct.unpack_from(b'!HHiH', data,
+                                                           self.offset)
+            self.offset += 10
+            end = self.offset + length
 
             rec = None
-            if type == _TYPE_A:
+            if types is not None and type not in types:
+                pass
+            elif type == _TYPE_A:
                 rec = DNSAddress(domain, type, class_, ttl, self.read_string(4))
             elif type == _TYPE_CNAME or type == _TYPE_PTR:
                 rec = DNSPointer(domain, type, class_, ttl, self.read_name())
             elif type == _TYPE_TXT:
                 rec = DNSText(domain, type, class_, ttl, self.read_string(length))
             elif type == _TYPE_SRV:
+                priority, weight, port = struct.unpack_from(b'!3H', data,
+                                                            self.offset)
+                self.offset += 6
                 rec = DNSService(domain, type, class_, ttl,
-                                 self.read_unsigned_short(), self.read_unsigned_short(),
-                                 self.read_unsigned_short(), self.read_name())
+                                 priority, weight, port, self.read_name())
             elif type == _TYPE_HINFO:
                 rec = DNSHinfo(domain, type, class_, ttl,
                                self.read_character_string(), self.read_character_string())
             elif type == _TYPE_AAAA:
                 rec = DNSAddress(domain, type, class_, ttl, self.read_string(16))
-            else:
-                # Try to ignore types we don't know about
-                # Skip the payload for the resource record so the next
-                # records can be parsed correctly
-                self.offset += length
+
+            # Skip the rest of the payload, or all of it for types we
+            # don't know about, so the next records can be parsed correctly
+            self.offset = end
 
             if rec is not None:
                 self.answers.append(rec)
@@ -551,52 +726,80 @@ class DNSIncoming(object):
 
     def read_name(self):
         """Reads a domain name from the packet"""
-        result = ''
-        off = self.offset
-        next = -1
+        name, self.offset = self.read_name_at(self.offset)
+        return name
+
+    def read_name_at(self, offset):
+        """Returns the domain name at the given offset and the offset
+        following it.  Names are remembered for every label they
+        contain, so suffixes shared by compression pointers are decoded
+        once."""
+        data = self.data
+        names = self.names
+        labels = []  # list of [label offset, label, offset following]
+        run = 0  # index of the first label read since the last pointer
+        off = offset
         first = off
+        end = None
+        suffix = ''
 
         while True:
-            length = indexbytes(self.data, off)
-            off += 1
+            cached = names.get(off)
+            if cached is not None:
+                suffix, run_end = cached
+                break
+            length = indexbytes(data, off)
             if length == 0:
+                run_end = off + 1
                 break
             t = length & 0xC0
             if t == 0x00:
-                result = ''.join((result, self.read_utf(off, length) + '.'))
-                off += length
+                labels.append([off, self.read_utf(off + 1, length), None])
+                off += length + 1
             elif t == 0xC0:
-                if next < 0:
-                    next = off + 1
-                off = ((length & 0x3F) << 8) | indexbytes(self.data, off)
+                for label in labels[run:]:
+                    label[2] = off + 2
+                run = len(labels)
+                if end is None:
+                    end = off + 2
+                off = ((length & 0x3F) << 8) | indexbytes(data, off + 1)
                 if off >= first:
-                    # TODO raise more specific exception
-                    raise Exception("Bad domain name (circular) at %s" % (off,))
+                    raise IncomingDecodeError(
+                        "Bad domain name (circular) at %s" % (off,))
                 first = off
             else:
-                # TODO raise more specific exception
-                raise Exception("Bad domain name at %s" % (off,))
+                raise IncomingDecodeError("Bad domain name at %s" % (off,))
 
-        if next >= 0:
-            self.offset = next
-        else:
-            self.offset = off
+        for label in labels[run:]:
+            label[2] = run_end
+        if end is None:
+            end = run_end
 
-        return result
+        name = suffix
+        for label_offset, label, following in reversed(labels):
+            name = label + '.' + name
+            names[label_offset] = (name, following)
+
+        return name, end
 
 
 class DNSOutgoing(object):
 
-    """Object representation of an outgoing packet"""
+    """Object representation of an outgoing packet
+
+    The packet is written into a preallocated bytearray.  Names and their
+    suffixes are compressed against every name already in the packet."""
 
     def __init__(self, flags, multicast=True):
         self.finished = False
         self.id = 0
         self.multicast = multicast
         self.flags = flags
-        self.names = {}
-        self.data = []
-        self.size = 12
+        # Offsets of the TTLs written, as tuples
+        # (index of the packet, offset, record)
+        self.ttl_offsets = []
+        self.finished_packets = []
+        self.start_packet()
 
         self.questions = []
         self.answers = []
@@ -626,32 +829,58 @@ class DNSOutgoing(object):
         """Adds an additional answer"""
         self.additionals.append(record)
 
+    def start_packet(self):
+        """Starts writing the next packet"""
+        self.names = {}
+        # Room for a typical packet, grows when needed
+        self.data = bytearray(_MAX_MSG_TYPICAL)
+        self.size = 12
+
+    def finish_packet(self, flags, questions, answers, authorities,
+                      additionals):
+        """Writes the header of the packet and adds it to the finished
+        packets"""
+        struct.pack_into(b'!6H', self.data, 0,
+                         0 if self.multicast else self.id, flags,
+                         questions, answers, authorities, additionals)
+        self.finished_packets.append(bytes(self.data[:self.size]))
+
+    def reserve(self, length):
+        """Makes room for length more bytes"""
+        if self.size + length > len(self.data):
+            self.data.extend(bytearray(max(length, len(self.data))))
+
     def pack(self, format, value):
-        self.data.append(struct.pack(format, value))
-        self.size += struct.calcsize(format)
+        length = struct.calcsize(format)
+        self.reserve(length)
+        struct.pack_into(format, self.data, self.size, value)
+        self.size += length
 
     def write_byte(self, value):
         """Writes a single byte to the packet"""
-        self.pack(b'!c', int2byte(value))
-
-    def insert_short(self, index, value):
-        """Inserts an unsigned short in a certain position in the packet"""
-        self.data.insert(index, struct.pack(b'!H', value))
-        self.size += 2
+        self.reserve(1)
+        self.data[self.size] = value
+        self.size += 1
 
     def write_short(self, value):
         """Writes an unsigned short to the packet"""
-        self.pack(b'!H', value)
+        self.reserve(2)
+        _SHORT.pack_into(self.data, self.size, value)
+        self.size += 2
 
     def write_int(self, value):
         """Writes an unsigned integer to the packet"""
-        self.pack(b'!I', int(value))
+        self.reserve(4)
+        _INT.pack_into(self.data, self.size, int(value))
+        self.size += 4
 
     def write_string(self, value):
         """Writes a string to the packet"""
         assert isinstance(value, bytes)
-        self.data.append(value)
-        self.size += len(value)
+        length = len(value)
+        self.reserve(length)
+        self.data[self.size:self.size + length] = value
+        self.size += length
 
     def write_utf(self, s):
         """Writes a UTF-8 string of a given length to the packet"""
@@ -659,39 +888,48 @@ class DNSOutgoing(object):
         length = len(utfstr)
         if length > 64:
             raise NamePartTooLongException
-        self.write_byte(length)
-        self.write_string(utfstr)
+        self.reserve(length + 1)
+        self.data[self.size] = length
+        self.data[self.size + 1:self.size + 1 + length] = utfstr
+        self.size += length + 1
 
     def write_name(self, name):
-        """Writes a domain name to the packet"""
-
-        if name in self.names:
-            # Find existing instance of this name in packet
-            #
-            index = self.names[name]
-
-            # An index was found, so write a pointer to it
-            #
-            self.write_byte((index >> 8) | 0xC0)
-            self.write_byte(index & 0xFF)
-        else:
-            # No record of this name already, so write it
-            # out as normal, recording the location of the name
-            # for future pointers to it.
+        """Writes a domain name to the packet
+
+        Labels are written until the rest of the name is found in the
+        packet, which is then written as a pointer to it.  Every suffix
+        written is recorded for later names."""
+
+        if not name.endswith('.'):
+            name += '.'
+        start = 0
+        end = len(name) - 1
+        while start < end:
+            suffix = name[start:]
+            index = self.names.get(suffix)
+            if index is not None:
+                # An index was found, so write a pointer to it
+                #
+                self.write_short(0xC000 | index)
+                return
+            # Pointers can only address the first 16 KB of the packet
             #
-            self.names[name] = self.size
-            parts = name.split('.')
-            if parts[-1] == '':
-                parts = parts[:-1]
-            for part in parts:
-                self.write_utf(part)
-            self.write_byte(0)
+            if self.size < 0x3FFF:
+                self.names[suffix] = self.size
+            dot = name.index('.', start)
+            self.write_utf(name[start:dot])
+            start = dot + 1
+        self.write_byte(0)
 
     def write_question(self, question):
         """Writes a question to the packet"""
         self.write_name(question.name)
         self.write_short(question.type)
-        self.write_short(question.class_)
+        if question.unique:
+            # Asks for a unicast response (RFC 6762, 5.4)
+            self.write_short(question.class_ | _CLASS_UNIQUE)
+        else:
+            self.write_short(question.class_)
 
     def write_record(self, record, now):
         """Writes a record (answer, authoritative answer, additional) to
@@ -702,19 +940,18 @@ class DNSOutgoing(object):
             self.write_short(record.class_ | _CLASS_UNIQUE)
         else:
             self.write_short(record.class_)
+        self.ttl_offsets.append((len(self.finished_packets), self.size,
+                                 record))
         if now == 0:
             self.write_int(record.ttl)
         else:
-            self.write_int(record.get_remaining_ttl(now))
-        index = len(self.data)
-        # Adjust size for the short we will write before this record
+            self.write_int(int(record.get_remaining_ttl(now)))
+        # Write the length after the record data is written
         #
-        self.size += 2
+        index = self.size
+        self.write_short(0)
         record.write(self)
-        self.size -= 2
-
-        length = len(b''.join(self.data[index:]))
-        self.insert_short(index, length)  # Here is the short we adjusted for
+        _SHORT.pack_into(self.data, index, self.size - index - 2)
 
     def packet(self):
         """Returns a string containing the packet's bytes
@@ -732,65 +969,292 @@ class DNSOutgoing(object):
             for additional in self.additionals:
                 self.write_record(additional, 0)
 
-            self.insert_short(0, len(self.additionals))
-            self.insert_short(0, len(self.authorities))
-            self.insert_short(0, len(self.answers))
-            self.insert_short(0, len(self.questions))
-            self.insert_short(0, self.flags)
-            if self.multicast:
-                self.insert_short(0, 0)
-            else:
-                self.insert_short(0, self.id)
-        return b''.join(self.data)
+            self.finish_packet(self.flags, len(self.questions),
+                               len(self.answers), len(self.authorities),
+                               len(self.additionals))
+        return self.finished_packets[0]
+
+    def packets(self):
+        """Returns a list of strings containing the bytes of packets
+
+        A query with more known answers than fit in a typical packet is
+        split.  The first packet holds the questions, the following ones
+        continue the known answers, and every packet but the last has the
+        truncated flag set (RFC 6762, 7.2).  Other packets aren't split.
+
+        No further parts should be added to the packet once this
+        is done."""
+        if (self.finished or self.authorities or self.additionals or
+                (self.flags & _FLAGS_QR_MASK) != _FLAGS_QR_QUERY):
+            self.packet()
+            return self.finished_packets
+
+        self.finished = True
+        questions = len(self.questions)
+        for question in self.questions:
+            self.write_question(question)
+        answers = 0
+        for answer, time_ in self.answers:
+            mark = self.size
+            ttl_offsets = len(self.ttl_offsets)
+            self.write_record(answer, time_)
+            if self.size <= _MAX_MSG_TYPICAL or (answers == 0 and
+                                                 questions == 0):
+                answers += 1
+                continue
+            # The answer doesn't fit, move it to the next packet
+            #
+            self.size = mark
+            del self.ttl_offsets[ttl_offsets:]
+            self.finish_packet(self.flags | _FLAGS_TC, questions, answers,
+                               0, 0)
+            self.start_packet()
+            questions = 0
+            self.write_record(answer, time_)
+            answers = 1
+        self.finish_packet(self.flags, questions, answers, 0, 0)
+        return self.finished_packets
+
+
+class DNSQueryTemplate(object):
+
+    """A query, which is encoded once and sent repeatedly.
+
+    Only the TTLs of known answers change between sends, they are
+    updated in place.  A new template is needed when the questions or
+    the known answers change, see matches()."""
+
+    def __init__(self, questions, answers):
+        self.key = (tuple((question.name, question.type, question.class_,
+                           question.unique)
+                          for question in questions),
+                    frozenset(answers))
+        out = DNSOutgoing(_FLAGS_QR_QUERY)
+        for question in questions:
+            out.add_question(question)
+        for answer in answers:
+            out.add_answer_at_time(answer, 0)
+        self.data = [bytearray(packet) for packet in out.packets()]
+        self.ttl_offsets = out.ttl_offsets
+        self.questions = out.questions
+        self.answers = out.answers
+
+    def matches(self, questions, answers):
+        """Returns true if the template asks the questions with the
+        known answers"""
+        return self.key == (
+            tuple((question.name, question.type, question.class_,
+                   question.unique)
+                  for question in questions),
+            frozenset(answers))
+
+    def packets(self):
+        """Returns the bytes of the packets with remaining TTLs of the
+        known answers"""
+        now = current_time_millis()
+        for index, offset, record in self.ttl_offsets:
+            _INT.pack_into(self.data[index], offset,
+                           int(record.get_remaining_ttl(now)))
+        return [bytes(packet) for packet in self.data]
+
+    def packet(self):
+        """Returns the bytes of the first packet"""
+        return self.packets()[0]
+
+
+def query_template(template, questions, answers):
+    """Returns the template if it matches the questions and known answers,
+    otherwise a new template for them"""
+    if template is not None and template.matches(questions, answers):
+        return template
+    return DNSQueryTemplate(questions, answers)
 
 
 class DNSCache(object):
 
-    """A cache of DNS entries"""
+    """A cache of DNS entries
 
-    def __init__(self):
+    Records are indexed by name and by (name, type, class), and are
+    stored in dicts keyed by the record itself, so adding, removing and
+    looking up a record don't depend on the size of the cache.
+
+    Expiration times are kept in a heap, so expired records are found
+    without walking the cache.
+
+    With max_records, the cache holds at most that many records.  Records
+    which were never looked up since they arrived, unsolicited answers
+    mostly, are evicted first, oldest first.  Then least recently used
+    records are evicted, preferring those which is_wanted(record)
+    doesn't claim."""
+
+    def __init__(self, max_records=None, is_wanted=None):
+        # Maps name to a dict of records with the name
         self.cache = {}
+        # Maps (name, type, class) to a dict of records with the details
+        self.details = {}
+        # Heap of (expiration time, sequence number, record)
+        self.expirations = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+        self.max_records = max_records
+        self.is_wanted = is_wanted
+        # Records in order of use, those never looked up kept apart
+        self.unused = OrderedDict()
+        self.used = OrderedDict()
+        self.size = 0
+        self.evictions = 0
 
     def add(self, entry):
-        """Adds an entry"""
-        self.cache.setdefault(entry.key, []).append(entry)
+        """Adds an entry, replacing an equal one"""
+        with self.lock:
+            self._remove(entry)
+            self.cache.setdefault(entry.key, {})[entry] = entry
+            self.details.setdefault(
+                (entry.key, entry.type, entry.class_), {})[entry] = entry
+            if self.is_wanted is not None and self.is_wanted(entry):
+                self.used[entry] = entry
+            else:
+                self.unused[entry] = entry
+            self.size += entry.size()
+            if self.max_records is not None:
+                while len(self.used) + len(self.unused) > self.max_records:
+                    self._remove(self._victim())
+                    self.evictions += 1
+        self.schedule(entry)
+
+    def _victim(self):
+        """Returns the entry to be evicted"""
+        if self.unused:
+            return next(iter(self.unused))
+        for count, entry in enumerate(self.used):
+            if count == _EVICTION_SCAN:
+                break
+            if self.is_wanted is None or not self.is_wanted(entry):
+                return entry
+        return next(iter(self.used))
+
+    def _touch(self, entries):
+        """Marks the entries as recently used"""
+        with self.lock:
+            for entry in entries:
+                if (self.unused.pop(entry, None) is not None or
+                        self.used.pop(entry, None) is not None):
+                    self.used[entry] = entry
+
+    def schedule(self, entry):
+        """Schedules expiration of an entry.  Needs to be called when
+        the TTL of a cached entry is reset to expire earlier."""
+        with self.lock:
+            heapq.heappush(self.expirations,
+                           (entry.get_expiration_time(100),
+                            next(self.counter), entry))
+            self._compact()
+
+    def _compact(self):
+        """Rebuilds the expiration heap without entries of removed
+        records, once they outnumber the cached records, so evicted
+        records don't stay in memory until they would have expired"""
+        live = len(self.used) + len(self.unused)
+        if len(self.expirations) <= 2 * live + _EXPIRATION_SLACK:
+            return
+        # Only the earliest entry of a record is needed, later ones are
+        # pushed again by expired() when they fall due
+        earliest = {}
+        for item in self.expirations:
+            entry = item[2]
+            if self.get(entry) is entry:
+                known = earliest.get(id(entry))
+                if known is None or item < known:
+                    earliest[id(entry)] = item
+        self.expirations = list(earliest.values())
+        heapq.heapify(self.expirations)
 
     def remove(self, entry):
         """Removes an entry"""
-        try:
-            list_ = self.cache[entry.key]
-            list_.remove(entry)
-        except (KeyError, ValueError):
-            pass
+        with self.lock:
+            self._remove(entry)
+            self._compact()
+
+    def _remove(self, entry):
+        for index, key in ((self.cache, entry.key),
+                           (self.details,
+                            (entry.key, entry.type, entry.class_))):
+            entries = index.get(key)
+            if entries is not None and entries.pop(entry, None) is not None:
+                if not entries:
+                    del index[key]
+        removed = self.unused.pop(entry, None)
+        if removed is None:
+            removed = self.used.pop(entry, None)
+        if removed is not None:
+            self.size -= removed.size()
 
     def get(self, entry):
         """Gets an entry by key.  Will return None if there is no
         matching entry."""
-        try:
-            list_ = self.cache[entry.key]
-            return list_[list_.index(entry)]
-        except (KeyError, ValueError):
-            return None
+        return self.cache.get(entry.key, {}).get(entry)
 
     def get_by_details(self, name, type, class_):
         """Gets an entry by details.  Will return None if there is
         no matching entry."""
-        entry = DNSEntry(name, type, class_)
-        return self.get(entry)
+        entries = self.details.get((name.lower(), type, class_))
+        if not entries:
+            return None
+        # The latest answer wins, e.g. the new address of a host
+        entry = max(list(entries.values()), key=lambda entry: entry.created)
+        self._touch((entry,))
+        return entry
 
     def entries_with_name(self, name):
         """Returns a list of entries whose key matches the name."""
-        try:
-            return self.cache[name]
-        except KeyError:
-            return []
+        entries = list(self.cache.get(name.lower(), {}).values())
+        if entries:
+            self._touch(entries)
+        return entries
 
     def entries(self):
         """Returns a list of all entries"""
-        if not self.cache:
-            return []
-        else:
-            return reduce(lambda a, b: a + b, self.cache.values())
+        return [entry for entries in list(self.cache.values())
+                for entry in list(entries.values())]
+
+    def stats(self):
+        """Returns a dict with the number of cached records, estimated
+        memory they and the expiration heap take in bytes and the number
+        of evicted records"""
+        with self.lock:
+            return {'entries': len(self.used) + len(self.unused),
+                    'bytes': (self.size +
+                              len(self.expirations) * _EXPIRATION_SIZE),
+                    'evictions': self.evictions,
+                    'max_records': self.max_records}
+
+    def next_expiration(self):
+        """Returns the time at which the next entry expires, or None
+        if the cache is empty."""
+        with self.lock:
+            if self.expirations:
+                return self.expirations[0][0]
+            return None
+
+    def expired(self, now):
+        """Returns a list of cached entries which have expired by now.
+        The entries stay in the cache until they are removed."""
+        result = []
+        with self.lock:
+            while self.expirations and self.expirations[0][0] <= now:
+                _, _, entry = heapq.heappop(self.expirations)
+                if self.get(entry) is not entry:
+                    # Removed, replaced or evicted since it was scheduled
+                    continue
+                expires = entry.get_expiration_time(100)
+                if expires > now:
+                    # The TTL was reset since it was scheduled
+                    heapq.heappush(self.expirations,
+                                   (expires, next(self.counter), entry))
+                elif not any(entry is other for other in result):
+                    result.append(entry)
+        return result
 
 
 class Engine(threading.Thread):
@@ -816,7 +1280,7 @@ class Engine(threading.Thread):
         self.start()
 
     def run(self):
-        while not _GLOBAL_DONE:
+        while not self.zc.done:
             rs = self.get_readers()
             if len(rs) == 0:
                 # No sockets to manage, but we wait for the timeout
@@ -856,6 +1320,214 @@ class Engine(threading.Thread):
             self.condition.notify()
 
 
+class _SelectPoller(object):
+
+    """Waits for readable file descriptors with select.select"""
+
+    def __init__(self):
+        self.fds = set()
+
+    def register(self, fd):
+        self.fds.add(fd)
+
+    def unregister(self, fd):
+        self.fds.discard(fd)
+
+    def poll(self, timeout):
+        """Returns readable file descriptors, timeout is in seconds"""
+        rr, wr, er = select.select(list(self.fds), [], [], timeout)
+        return rr
+
+
+class _PollPoller(object):
+
+    """Waits for readable file descriptors with select.poll"""
+
+    def __init__(self):
+        self.poller = select.poll()
+
+    def register(self, fd):
+        self.poller.register(fd, select.POLLIN)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        """Returns readable file descriptors, timeout is in seconds"""
+        if timeout is not None:
+            timeout = int(timeout * 1000) + 1
+        return [fd for fd, event in self.poller.poll(timeout)]
+
+
+class _EpollPoller(object):
+
+    """Waits for readable file descriptors with select.epoll"""
+
+    def __init__(self):
+        self.poller = select.epoll()
+
+    def register(self, fd):
+        self.poller.register(fd, select.EPOLLIN)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        """Returns readable file descriptors, timeout is in seconds"""
+        if timeout is None:
+            timeout = -1
+        return [fd for fd, event in self.poller.poll(timeout)]
+
+
+# Errors of pollers, select.error being distinct from IOError on Python 2
+_POLL_ERRORS = (IOError, OSError, ValueError, select.error, socket.error)
+
+
+def new_poller():
+    """Returns the most efficient poller available on the platform"""
+    if hasattr(select, 'epoll'):
+        return _EpollPoller()
+    if hasattr(select, 'poll'):
+        return _PollPoller()
+    return _SelectPoller()
+
+
+class LoopEngine(threading.Thread):
+
+    """An engine which reads sockets and runs timers of a Zeroconf
+    instance on a single thread.  It replaces Engine, the Reaper thread
+    and the threads of ServiceBrowsers when Zeroconf is created with
+    single_thread=True.
+
+    Sockets are multiplexed with epoll or poll where available.  Other
+    threads wake the loop up by sending a datagram to a socket, which the
+    loop reads along with the others.
+    """
+
+    def __init__(self, zc):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.zc = zc
+        self.readers = {}  # maps file descriptor to (socket, reader)
+        # Maps file descriptors known to the poller to their sockets
+        self.registered = {}
+        self.timers = []  # heap of (time, sequence number, callback)
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.poller = new_poller()
+
+        self._wakeup_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._wakeup_socket.bind(('127.0.0.1', 0))
+        self._wakeup_socket.setblocking(False)
+        self._wakeup_address = self._wakeup_socket.getsockname()
+        self.readers[self._wakeup_socket.fileno()] = (
+            self._wakeup_socket, None)
+        self.start()
+
+    def run(self):
+        while not self.zc.done:
+            self.update_poller()
+            timeout = self.run_timers()
+            try:
+                fds = self.poller.poll(timeout)
+            except _POLL_ERRORS as e:
+                # On Python 2 epoll raises IOError, select and poll raise
+                # select.error, none of them being a socket.error
+                if e.args[:1] != (errno.EINTR,) and not self.zc.done:
+                    log.exception('Unknown error, possibly benign: %r', e)
+                continue
+            for fd in fds:
+                socket_, reader = self.readers.get(fd, (None, None))
+                if socket_ is self._wakeup_socket:
+                    self.drain_wakeups()
+                elif reader is not None:
+                    try:
+                        reader.handle_read(socket_)
+                    except Exception as e:
+                        # A failing reader mustn't stop the loop
+                        log.exception('Unknown error, possibly benign: %r', e)
+        self._wakeup_socket.close()
+
+    def update_poller(self):
+        """Registers added sockets and unregisters removed ones.  A new
+        socket may get the descriptor of a closed one, so sockets are
+        compared, not just descriptors."""
+        with self.lock:
+            sockets = dict((fd, socket_)
+                           for fd, (socket_, _) in self.readers.items())
+        for fd, socket_ in self.registered.items():
+            if sockets.get(fd) is not socket_:
+                try:
+                    self.poller.unregister(fd)
+                except _POLL_ERRORS + (KeyError,) as e:
+                    log.debug('Unregistering closed socket: %r', e)
+        for fd, socket_ in list(sockets.items()):
+            if self.registered.get(fd) is not socket_:
+                try:
+                    self.poller.register(fd)
+                except _POLL_ERRORS as e:
+                    # Closed before its reader was removed, which will
+                    # follow
+                    log.debug('Registering closed socket: %r', e)
+                    del sockets[fd]
+        self.registered = sockets
+
+    def run_timers(self):
+        """Runs the timers which are due.  Returns the number of seconds
+        until the next timer, or None if there are no timers."""
+        while True:
+            with self.lock:
+                if not self.timers:
+                    return None
+                now = current_time_millis()
+                if self.timers[0][0] > now:
+                    return (self.timers[0][0] - now) / 1000
+                _, _, callback = heapq.heappop(self.timers)
+            try:
+                callback()
+            except Exception as e:
+                # A failing timer mustn't stop the loop
+                log.exception('Unknown error, possibly benign: %r', e)
+
+    def drain_wakeups(self):
+        while True:
+            try:
+                self._wakeup_socket.recv(64)
+            except socket.error:
+                return
+
+    def call_at(self, when, callback):
+        """Calls the callback on the loop at the given time in
+        milliseconds."""
+        with self.lock:
+            heapq.heappush(self.timers, (when, next(self.counter), callback))
+            first = self.timers[0][2] is callback
+        if first and threading.current_thread() is not self:
+            self.notify()
+
+    def call_soon(self, callback):
+        """Calls the callback on the loop as soon as possible."""
+        self.call_at(0, callback)
+
+    def add_reader(self, reader, socket_):
+        with self.lock:
+            self.readers[socket_.fileno()] = (socket_, reader)
+        self.notify()
+
+    def del_reader(self, socket_):
+        with self.lock:
+            for fd, (known, reader) in list(self.readers.items()):
+                if known is socket_:
+                    del self.readers[fd]
+        self.notify()
+
+    def notify(self):
+        try:
+            self._wakeup_socket.sendto(b'\x00', self._wakeup_address)
+        except socket.error as e:
+            log.debug('Waking up the loop failed: %r', e)
+
+
 class Listener(object):
 
     """A Listener is used by this module to listen on the multicast
@@ -863,10 +1535,74 @@ class Listener(object):
     to cache information as it arrives.
 
     It requires registration with an Engine object in order to have
-    the read() method called when a socket is availble for reading."""
+    the read() method called when a socket is availble for reading.
+
+    Packets repeating one received within _DUPLICATE_TIME are dropped
+    before they are parsed, and so are packets of a source, which sends
+    more than _SOURCE_RATE packets per second.  The counters duplicates
+    and flooded tell how many were dropped."""
 
     def __init__(self, zc):
         self.zc = zc
+        # Truncated queries waiting for more known answers, by source
+        self.truncated = {}
+        # Maps digests of recent packets to the time they were last
+        # received, and queue of (time, digest) in the order they were
+        # received
+        self.recent = {}
+        self.recent_order = deque()
+        # Maps source address to (tokens, time of the last packet)
+        self.sources = {}
+        self.duplicates = 0
+        self.flooded = 0
+
+    def admit(self, data, addr, port, now):
+        """Returns true if the packet should be handled, false if it is
+        a duplicate or its source is flooding"""
+        bucket = self.sources.get(addr)
+        if bucket is None:
+            if len(self.sources) >= _SOURCE_ENTRIES:
+                self.forget_sources(now)
+            tokens = _SOURCE_BURST
+        else:
+            tokens, last = bucket
+            tokens = min(_SOURCE_BURST,
+                         tokens + (now - last) * _SOURCE_RATE / 1000)
+        if tokens < 1:
+            self.sources[addr] = (tokens, now)
+            self.flooded += 1
+            return False
+        self.sources[addr] = (tokens - 1, now)
+
+        digest = hashlib.sha1()
+        if port != _MDNS_PORT:
+            # Legacy unicast queries are answered to each sender
+            digest.update(socket.inet_aton(addr) + _SHORT.pack(port))
+        digest.update(data)
+        digest = digest.digest()
+        recent = self.recent
+        order = self.recent_order
+        while order and (order[0][0] <= now - _DUPLICATE_TIME or
+                         len(order) >= _DUPLICATE_PACKETS):
+            received, packet = order.popleft()
+            if recent.get(packet) == received:
+                del recent[packet]
+        if digest in recent:
+            self.duplicates += 1
+            return False
+        recent[digest] = now
+        order.append((now, digest))
+        return True
+
+    def forget_sources(self, now):
+        """Drops sources, whose tokens have been refilled, or all of
+        them if there are no such sources"""
+        idle = now - _SOURCE_BURST * 1000 / _SOURCE_RATE
+        for addr, (_, last) in list(self.sources.items()):
+            if last <= idle:
+                del self.sources[addr]
+        if len(self.sources) >= _SOURCE_ENTRIES:
+            self.sources.clear()
 
     def handle_read(self, socket_):
         try:
@@ -882,44 +1618,161 @@ class Listener(object):
         else:
             log.debug('Received %r from %r:%r', data, addr, port)
 
+        if not self.admit(data, addr, port, current_time_millis()):
+            return
         self.data = data
-        msg = DNSIncoming(data)
+        if (len(data) >= 12 and not self.zc.services and
+                not self.zc.running_browsers and
+                (indexbytes(data, 2) << 8) & _FLAGS_QR_MASK == _FLAGS_QR_QUERY):
+            # Nothing to answer or to learn from, don't parse the query
+            return
+        msg = DNSIncoming(data, self.zc.record_types)
         if msg.is_query():
-            # Always multicast responses
-            #
-            if port == _MDNS_PORT:
-                self.zc.handle_query(msg, _MDNS_ADDR, _MDNS_PORT)
-            # If it's not a multicast query, reply via unicast
-            # and multicast
-            #
-            elif port == _DNS_PORT:
-                self.zc.handle_query(msg, addr, port)
-                self.zc.handle_query(msg, _MDNS_ADDR, _MDNS_PORT)
+            key = (addr, port)
+            pending = self.truncated.get(key)
+            if pending is not None and not msg.questions:
+                # Known answers continuing a truncated query
+                pending.answers.extend(msg.answers)
+                if msg.flags & _FLAGS_TC:
+                    return
+                self.truncated.pop(key, None)
+                msg = pending
+            elif msg.flags & _FLAGS_TC:
+                # Wait for the rest of the known answers (RFC 6762, 7.2)
+                self.truncated[key] = msg
+                self.zc.call_later(random.randint(400, 500),
+                                   lambda: self.flush(key, msg))
+                return
+            self.handle_query(msg, addr, port)
         else:
             self.zc.handle_response(msg)
 
+    def flush(self, key, msg):
+        """Handles a truncated query, whose known answers didn't
+        continue in time"""
+        if self.truncated.get(key) is msg:
+            self.truncated.pop(key, None)
+            self.handle_query(msg, *key)
+
+    def handle_query(self, msg, addr, port):
+        if port == _MDNS_PORT and addr not in self.zc.addresses:
+            self.zc.handle_foreign_query(msg)
+        if not self.zc.services:
+            return
+        # Always multicast responses
+        #
+        if port == _MDNS_PORT:
+            self.zc.handle_query(msg, _MDNS_ADDR, _MDNS_PORT)
+        # If it's not a multicast query, reply via unicast
+        # and multicast
+        #
+        elif port == _DNS_PORT:
+            self.zc.handle_query(msg, addr, port)
+            self.zc.handle_query(msg, _MDNS_ADDR, _MDNS_PORT)
+
 
 class Reaper(threading.Thread):
 
     """A Reaper is used by this module to remove cache entries that
-    have expired."""
+    have expired, and to refresh records of interest before they do.
+
+    It sleeps until the next expiration or refresh is due, or until it is
+    woken up for an earlier one."""
 
     def __init__(self, zc):
         threading.Thread.__init__(self)
         self.daemon = True
         self.zc = zc
+        self.next_time = None
+        self.condition = threading.Condition()
         self.start()
 
+    def wake(self, when):
+        """Makes the reaper run at the given time in milliseconds, unless
+        it is going to run earlier."""
+        with self.condition:
+            if self.next_time is None or when < self.next_time:
+                self.next_time = when
+                self.condition.notify()
+
     def run(self):
         while True:
-            self.zc.wait(10 * 1000)
-            if _GLOBAL_DONE:
+            with self.condition:
+                while not self.zc.done:
+                    now = current_time_millis()
+                    if self.next_time is None:
+                        self.condition.wait()
+                    elif self.next_time > now:
+                        self.condition.wait((self.next_time - now) / 1000)
+                    else:
+                        break
+                if self.zc.done:
+                    return
+                self.next_time = None
+            next_time = self.zc.reap(current_time_millis())
+            if next_time is not None:
+                self.wake(next_time)
+
+
+class LoopReaper(object):
+
+    """Removes expired cache entries and refreshes records of interest
+    with timers of a LoopEngine, instead of a thread of its own."""
+
+    def __init__(self, zc):
+        self.zc = zc
+        self.next_time = None
+
+    def wake(self, when):
+        """Makes the reaper run at the given time in milliseconds, unless
+        it is going to run earlier."""
+        if self.next_time is None or when < self.next_time:
+            self.next_time = when
+            self.zc.engine.call_at(when, lambda: self.run(when))
+
+    def run(self, when):
+        if when != self.next_time or self.zc.done:
+            # Superseded by an earlier run
+            return
+        self.next_time = None
+        next_time = self.zc.reap(current_time_millis())
+        if next_time is not None:
+            self.wake(next_time)
+
+
+class Dispatcher(threading.Thread):
+
+    """Calls ServiceBrowser handlers of a single thread Zeroconf.
+
+    Handlers usually request service information and wait for the
+    answer, which the loop has to read, so they can't run on the loop.
+    One dispatcher serves all browsers of the instance."""
+
+    def __init__(self, zc):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.zc = zc
+        self.queue = queue.Queue()
+        self.start()
+
+    def dispatch(self, handler):
+        """Calls handler(zc) on the dispatcher thread"""
+        self.queue.put(handler)
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            handler = self.queue.get()
+            if handler is None or self.zc.done:
                 return
-            now = current_time_millis()
-            for record in self.zc.cache.entries():
-                if record.is_expired(now):
-                    self.zc.update_record(now, record)
-                    self.zc.cache.remove(record)
+            try:
+                handler(self.zc)
+            except Exception as e:
+                # Handlers are listener code, which mustn't stop the
+                # dispatcher
+                log.exception('Unknown error, possibly benign: %r', e)
 
 
 class Signal(object):
@@ -955,9 +1808,21 @@ class ServiceBrowser(threading.Thread):
 
     The listener object will have its add_service() and
     remove_service() methods called when this browser
-    discovers changes in the services availability."""
+    discovers changes in the services availability, and its
+    update_service() method, if it has one, when SRV, TXT or A records
+    of a known service change or are refreshed.
+
+    With a single thread Zeroconf, the browser doesn't start its thread:
+    queries are sent from timers of the loop and the listener is called
+    from the dispatcher of the Zeroconf instance.
+
+    With resolve, the browser asks for SRV, TXT and A records of new
+    services, which aren't cached yet, in one query for all services
+    found within _RESOLVE_TIME.  Requests for their service information
+    are then answered from the cache."""
 
-    def __init__(self, zc, type_, handlers=None, listener=None):
+    def __init__(self, zc, type_, handlers=None, listener=None,
+                 resolve=False):
         """Creates a browser for a specific type"""
         assert handlers or listener, 'You need to specify at least one handler'
         threading.Thread.__init__(self)
@@ -968,12 +1833,21 @@ class ServiceBrowser(threading.Thread):
         self.next_time = current_time_millis()
         self.delay = _BROWSER_TIME
         self._handlers_to_call = []
+        self._scheduled = None
+        self._question = DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN)
+        # The first query asks for unicast responses, which arrive sooner
+        # and spare the network multicast answers (RFC 6762, 5.4)
+        self._first_question = DNSQuestion(self.type, _TYPE_PTR,
+                                           _CLASS_IN | _CLASS_UNIQUE)
+        self._template = None
+        self.resolve = resolve
+        self._to_resolve = []
+        self._resolve_lock = threading.Lock()
+        # Set when the browser thread should look at its state again
+        self._wakeup = threading.Event()
 
         self.done = False
 
-        self.zc.add_listener(self, DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
-        self.start()
-
         self._service_state_changed = Signal()
 
         if hasattr(handlers, 'add_service'):
@@ -989,6 +1863,10 @@ class ServiceBrowser(threading.Thread):
                     listener.add_service(*args)
                 elif state_change is ServiceStateChange.Removed:
                     listener.remove_service(*args)
+                elif state_change is ServiceStateChange.Updated:
+                    update_service = getattr(listener, 'update_service', None)
+                    if update_service is not None:
+                        update_service(*args)
                 else:
                     raise NotImplementedError(state_change)
             handlers.append(on_change)
@@ -996,6 +1874,14 @@ class ServiceBrowser(threading.Thread):
         for h in handlers:
             self.service_state_changed.register_handler(h)
 
+        self.zc.add_interest(self.type)
+        self.zc.add_listener(self, DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
+        self.zc.running_browsers.append(self)
+        if self.zc.single_thread:
+            self.schedule()
+        else:
+            self.start()
+
     @property
     def service_state_changed(self):
         return self._service_state_changed.registration_interface
@@ -1006,13 +1892,20 @@ class ServiceBrowser(threading.Thread):
         Updates information required by browser in the Zeroconf cache."""
 
         def enqueue_callback(state_change, name):
-            self._handlers_to_call.append(
-                lambda zeroconf: self._service_state_changed.fire(
-                    zeroconf=zeroconf,
-                    service_type=self.type,
-                    name=name,
-                    state_change=state_change,
-                ))
+            def handler(zeroconf):
+                # The Zeroconf instance may outlive a cancelled browser
+                if not self.done:
+                    self._service_state_changed.fire(
+                        zeroconf=zeroconf,
+                        service_type=self.type,
+                        name=name,
+                        state_change=state_change,
+                    )
+            if self.zc.single_thread:
+                self.zc.dispatcher.dispatch(handler)
+            else:
+                self._handlers_to_call.append(handler)
+                self._wakeup.set()
 
         if record.type == _TYPE_PTR and record.name == self.type:
             expired = record.is_expired(now)
@@ -1022,41 +1915,187 @@ class ServiceBrowser(threading.Thread):
             except KeyError:
                 if not expired:
                     self.services[service_key] = record
+                    # Keep SRV and TXT records of the service fresh
+                    zc.add_interest(service_key)
+                    if self.resolve:
+                        self.add_to_resolve(record.alias)
                     enqueue_callback(ServiceStateChange.Added, record.alias)
             else:
                 if not expired:
                     old_record.reset_ttl(record)
                 else:
                     del self.services[service_key]
+                    zc.remove_interest(service_key)
                     enqueue_callback(ServiceStateChange.Removed, record.alias)
                     return
 
             expires = record.get_expiration_time(75)
             if expires < self.next_time:
                 self.next_time = expires
+                if self.zc.single_thread:
+                    self.schedule()
+                else:
+                    self._wakeup.set()
+        elif record.is_expired(now):
+            # Expiry is told by the PTR record of the service
+            return
+        elif record.type in (_TYPE_SRV, _TYPE_TXT):
+            pointer = self.services.get(record.key)
+            if pointer is not None:
+                enqueue_callback(ServiceStateChange.Updated, pointer.alias)
+        elif record.type == _TYPE_A:
+            for service_key, pointer in list(self.services.items()):
+                service = zc.cache.get_by_details(service_key, _TYPE_SRV,
+                                                  _CLASS_IN)
+                if service is not None and service.server.lower() == record.key:
+                    enqueue_callback(ServiceStateChange.Updated,
+                                     pointer.alias)
+
+    def add_to_resolve(self, name):
+        """Queues a new service for the next resolving query"""
+        with self._resolve_lock:
+            self._to_resolve.append(name)
+            first = len(self._to_resolve) == 1
+        if first:
+            self.zc.call_later(_RESOLVE_TIME, self.send_resolve_query)
+
+    def send_resolve_query(self):
+        """Asks for the records of queued services, which aren't cached"""
+        with self._resolve_lock:
+            names, self._to_resolve = self._to_resolve, []
+        if self.done:
+            return
+        cache = self.zc.cache
+        out = DNSOutgoing(_FLAGS_QR_QUERY)
+        # This is the first query for the services, ask for unicast
+        class_ = _CLASS_IN | _CLASS_UNIQUE
+        for name in names:
+            service = cache.get_by_details(name, _TYPE_SRV, _CLASS_IN)
+            if service is None:
+                out.add_question(DNSQuestion(name, _TYPE_SRV, class_))
+            elif cache.get_by_details(service.server, _TYPE_A,
+                                      _CLASS_IN) is None:
+                out.add_question(DNSQuestion(service.server, _TYPE_A,
+                                             class_))
+            if cache.get_by_details(name, _TYPE_TXT, _CLASS_IN) is None:
+                out.add_question(DNSQuestion(name, _TYPE_TXT, class_))
+        if out.questions:
+            self.zc.send(out)
 
     def cancel(self):
+        if self.done:
+            return
         self.done = True
-        self.zc.notify_all()
+        try:
+            self.zc.running_browsers.remove(self)
+        except ValueError:
+            pass
+        self.zc.remove_listener(self)
+        self.zc.remove_interest(self.type)
+        for service_key in list(self.services):
+            self.zc.remove_interest(service_key)
+        self.wake()
+
+    def wake(self):
+        """Makes the browser thread check its state, for example after
+        the browser was cancelled"""
+        self._wakeup.set()
+
+    def known_answers(self, now):
+        """Returns the records to send as known answers, which are those
+        with more than half of their TTL remaining (RFC 6762, 7.1)"""
+        unconfirmed = self.zc.unconfirmed
+        return [record for record in self.services.values()
+                if not record.is_stale(now) and record not in unconfirmed]
+
+    def query(self, now):
+        """Sends the browsing query, if it is due"""
+        if self.next_time <= now:
+            if self._template is None:
+                question = self._first_question
+            else:
+                question = self._question
+            self._template = query_template(self._template, [question],
+                                            self.known_answers(now))
+            self.zc.send(self._template)
+            self.sent(now)
+
+    def requery(self, socket_):
+        """Sends the first browsing query again through the socket of a
+        new interface"""
+        if self.done:
+            return
+        now = current_time_millis()
+        out = DNSOutgoing(_FLAGS_QR_QUERY)
+        out.add_question(self._first_question)
+        for record in self.known_answers(now):
+            out.add_answer_at_time(record, now)
+        self.zc.send(out, sockets=[socket_])
+
+    def browse_again(self):
+        """Starts the queries over, as if the browser was new, when the
+        cached answers have to be confirmed again"""
+        if self.done:
+            return
+        self._template = None
+        self.delay = _BROWSER_TIME
+        self.next_time = current_time_millis()
+        if self.zc.single_thread:
+            self.schedule()
+        else:
+            self.wake()
+
+    def sent(self, now):
+        """Schedules the query after one which was sent now"""
+        self.next_time = now + self.delay
+        self.delay = min(20 * 1000, self.delay * 2)
+
+    def suppress_query(self, now, known_answers):
+        """Called when another host asked the question of this browser.
+        If all its known answers for our type are among ours, the
+        responses bring everything we miss, so our next query is treated
+        as sent (RFC 6762, 7.3) and hosts browsing the same type share
+        queries.  Another host knowing answers we don't would have them
+        left out of the responses, so we query anyway.
+
+        :type known_answers: set of records
+        """
+        ours = set(self.known_answers(now))
+        key = self.type.lower()
+        if all(record in ours for record in known_answers
+               if record.type == _TYPE_PTR and record.key == key):
+            self.sent(now)
+
+    def schedule(self):
+        """Schedules the next query on the loop of a single thread
+        Zeroconf"""
+        next_time = self.next_time
+        if self._scheduled is None or next_time < self._scheduled:
+            self._scheduled = next_time
+            self.zc.engine.call_at(next_time, lambda: self.step(next_time))
+
+    def step(self, when):
+        """Timer callback of a single thread Zeroconf"""
+        if when != self._scheduled or self.zc.done or self.done:
+            # Superseded by an earlier step, or cancelled
+            return
+        self._scheduled = None
+        self.query(current_time_millis())
+        self.schedule()
 
     def run(self):
         while True:
+            # Cleared before the state is checked, so a wakeup in between
+            # isn't lost
+            self._wakeup.clear()
             now = current_time_millis()
             if len(self._handlers_to_call) == 0 and self.next_time > now:
-                self.zc.wait(self.next_time - now)
-            if _GLOBAL_DONE or self.done:
+                self._wakeup.wait((self.next_time - now) / 1000)
+            if self.zc.done or self.done:
                 return
             now = current_time_millis()
 
-            if self.next_time <= now:
-                out = DNSOutgoing(_FLAGS_QR_QUERY)
-                out.add_question(DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
-                for record in self.services.values():
-                    if not record.is_expired(now):
-                        out.add_answer_at_time(record, now)
-                self.zc.send(out)
-                self.next_time = now + self.delay
-                self.delay = min(20 * 1000, self.delay * 2)
+            self.query(now)
 
             if len(self._handlers_to_call) > 0:
                 handler = self._handlers_to_call.pop(0)
@@ -1188,47 +2227,30 @@ class ServiceInfo(object):
                 if record.name == self.name:
                     self._set_text(record.text)
 
+    def is_resolved(self):
+        """Returns true if server, address and text are known"""
+        return (self.server is not None and self.address is not None and
+                self.text is not None)
+
+    def add_query(self, zc, now, questions, answers, unicast=False):
+        """Adds the questions for this service to the lists of a query,
+        along with the cached answers to them.  With unicast, the
+        questions ask for unicast responses."""
+        details = [(self.name, _TYPE_SRV), (self.name, _TYPE_TXT)]
+        if self.server is not None:
+            details.append((self.server, _TYPE_A))
+        class_ = _CLASS_IN | _CLASS_UNIQUE if unicast else _CLASS_IN
+        for name, type_ in details:
+            questions.append(DNSQuestion(name, type_, class_))
+            answer = zc.cache.get_by_details(name, type_, _CLASS_IN)
+            if answer is not None and not answer.is_expired(now):
+                answers.append(answer)
+
     def request(self, zc, timeout):
         """Returns true if the service could be discovered on the
         network, and updates this object with details discovered.
         """
-        now = current_time_millis()
-        delay = _LISTENER_TIME
-        next = now + delay
-        last = now + timeout
-        result = False
-        try:
-            zc.add_listener(self, DNSQuestion(self.name, _TYPE_ANY, _CLASS_IN))
-            while (self.server is None or self.address is None or
-                   self.text is None):
-                if last <= now:
-                    return False
-                if next <= now:
-                    out = DNSOutgoing(_FLAGS_QR_QUERY)
-                    out.add_question(DNSQuestion(self.name, _TYPE_SRV,
-                                                 _CLASS_IN))
-                    out.add_answer_at_time(zc.cache.get_by_details(self.name,
-                                                                   _TYPE_SRV, _CLASS_IN), now)
-                    out.add_question(DNSQuestion(self.name, _TYPE_TXT,
-                                                 _CLASS_IN))
-                    out.add_answer_at_time(zc.cache.get_by_details(self.name,
-                                                                   _TYPE_TXT, _CLASS_IN), now)
-                    if self.server is not None:
-                        out.add_question(DNSQuestion(self.server,
-                                                     _TYPE_A, _CLASS_IN))
-                        out.add_answer_at_time(zc.cache.get_by_details(self.server,
-                                                                       _TYPE_A, _CLASS_IN), now)
-                    zc.send(out)
-                    next = now + delay
-                    delay = delay * 2
-
-                zc.wait(min(next, last) - now)
-                now = current_time_millis()
-            result = True
-        finally:
-            zc.remove_listener(self)
-
-        return result
+        return zc.request_service_infos([self], timeout)
 
     def __eq__(self, other):
         """Tests equality of service name"""
@@ -1264,18 +2286,31 @@ class InterfaceChoice(enum.Enum):
 class ServiceStateChange(enum.Enum):
     Added = 1
     Removed = 2
+    Updated = 3
 
 
 HOST_ONLY_NETWORK_MASK = '255.255.255.255'
 
 
-def get_all_addresses(address_family):
-    return list(set(
+# Maps address family to (time, addresses) of the last enumeration
+_all_addresses = {}
+
+
+def get_all_addresses(address_family, max_age=_ADDRESS_CACHE_TIME):
+    """Returns the addresses of the interfaces, but host-only ones.
+    Addresses enumerated less than max_age milliseconds ago are reused."""
+    now = current_time_millis()
+    cached = _all_addresses.get(address_family)
+    if cached is not None and now - cached[0] < max_age:
+        return list(cached[1])
+    addresses = list(set(
         addr['addr']
         for iface in netifaces.interfaces()
         for addr in netifaces.ifaddresses(iface).get(address_family, [])
         if addr.get('netmask') != HOST_ONLY_NETWORK_MASK
     ))
+    _all_addresses[address_family] = (now, addresses)
+    return list(addresses)
 
 
 def normalize_interface_choice(choice, address_family):
@@ -1330,60 +2365,212 @@ class Zeroconf(object):
     def __init__(
         self,
         interfaces=InterfaceChoice.All,
+        single_thread=False,
+        max_cache_records=_CACHE_RECORDS,
+        cache_path=None,
+        record_types=None,
     ):
         """Creates an instance of the Zeroconf class, establishing
         multicast communications, listening and reaping threads.
 
+        With single_thread, sockets, expiry and browser queries are all
+        handled by one LoopEngine thread, and browser handlers are called
+        from one Dispatcher thread, however many browsers there are.
+
+        The cache holds at most max_cache_records records, or is
+        unbounded with None.  Records nobody asked for are evicted first,
+        see cache.stats() for the counters.
+
+        With cache_path, the cache is loaded from a snapshot in that file,
+        which is saved again when the instance is closed.  Browsers report
+        the loaded services at once, and the records are dropped unless
+        hosts confirm them within _CONFIRM_TIME.
+
+        With record_types, only records of these types are parsed from
+        incoming packets and from the snapshot, see record_types below.
+
         :type interfaces: :class:`InterfaceChoice` or sequence of ip addresses
+        :type single_thread: bool
+        :type max_cache_records: int or None
+        :type cache_path: str or None
+        :type record_types: set of int or None
         """
-        global _GLOBAL_DONE
-        _GLOBAL_DONE = False
+        # Tells the threads of this instance to stop
+        self.done = False
 
         self._listen_socket = new_socket()
+        watch_interfaces = interfaces is InterfaceChoice.All
         interfaces = normalize_interface_choice(interfaces, socket.AF_INET)
+        # Queries from these addresses are our own
+        self.addresses = set(get_all_addresses(socket.AF_INET))
+        self.addresses.update(interfaces)
 
+        # Respond sockets by the address of their interface
+        self._interfaces = {}
         self._respond_sockets = []
+        # Addresses of the interfaces, which are watched for changes
+        # when all interfaces are used
+        self.interface_addresses = set(interfaces)
 
         for i in interfaces:
-            log.debug('Adding %r to multicast group', i)
-            try:
-                self._listen_socket.setsockopt(
-                    socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
-                    socket.inet_aton(_MDNS_ADDR) + socket.inet_aton(i))
-            except socket.error as e:
-                if get_errno(e) == errno.EADDRINUSE:
-                    log.info(
-                        'Address in use when adding %s to multicast group, '
-                        'it is expected to happen on some systems', i,
-                    )
-                elif get_errno(e) == errno.EADDRNOTAVAIL:
-                    log.info(
-                        'Address not available when adding %s to multicast group, '
-                        'it is expected to happen on some systems', i,
-                    )
-                    continue
-                else:
-                    raise
+            self.add_interface(i)
 
-            respond_socket = new_socket()
-            respond_socket.setsockopt(
-                socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(i))
-
-            self._respond_sockets.append(respond_socket)
+        # Types of records which are parsed from incoming packets, or None
+        # for all supported types. Records of other types are skipped
+        self.record_types = record_types
 
         self.listeners = []
         self.browsers = []
+        # Browsers which haven't been cancelled
+        self.running_browsers = []
         self.services = {}
         self.servicetypes = {}
 
-        self.cache = DNSCache()
+        self.cache = DNSCache(max_cache_records, self.is_wanted)
 
-        self.condition = threading.Condition()
+        # Maps names, whose records are refreshed before they expire,
+        # to the number of users interested in them
+        self.interests = {}
+        # Heap of (refresh time, sequence number, record), holding the
+        # next refresh of each record
+        self.refreshes = []
+        # Maps records to [time of their entry in the heap, refresh times
+        # which are left, the cached record]
+        self.refresh_times = {}
+        self.refresh_counter = itertools.count()
+        self.refresh_lock = threading.Lock()
 
-        self.engine = Engine(self)
+        self.condition = threading.Condition()
+        # Maps (lowercase name, type) to events of the threads waiting for
+        # such records, _TYPE_ANY matching records of all types
+        self.waiters = {}
+        self.waiters_lock = threading.Lock()
+
+        # Maps records, which no answer has confirmed since they were
+        # loaded from a snapshot or their interface went away, to the
+        # time they expire at
+        self.unconfirmed = {}
+        self.cache_path = cache_path
+
+        self.single_thread = single_thread
+        if single_thread:
+            self.engine = LoopEngine(self)
+            self.reaper = LoopReaper(self)
+            self.dispatcher = Dispatcher(self)
+        else:
+            self.reaper = Reaper(self)
+            self.engine = Engine(self)
         self.listener = Listener(self)
         self.engine.add_reader(self.listener, self._listen_socket)
-        self.reaper = Reaper(self)
+        # Responses to questions asking for unicast are sent to the port of
+        # the query, where they may reach any of the sockets bound to it
+        for respond_socket in self._respond_sockets:
+            self.engine.add_reader(self.listener, respond_socket)
+        if watch_interfaces:
+            self.call_later(_INTERFACE_CHECK_TIME, self.check_interfaces)
+
+        if cache_path is not None:
+            self.load_cache(cache_path)
+
+    def add_interface(self, i):
+        """Joins the multicast group on the interface with address i and
+        opens a socket for sending through it.  Returns the socket, or
+        None if the interface isn't available."""
+        log.debug('Adding %r to multicast group', i)
+        try:
+            self._listen_socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                socket.inet_aton(_MDNS_ADDR) + socket.inet_aton(i))
+        except socket.error as e:
+            if get_errno(e) == errno.EADDRINUSE:
+                log.info(
+                    'Address in use when adding %s to multicast group, '
+                    'it is expected to happen on some systems', i,
+                )
+            elif get_errno(e) == errno.EADDRNOTAVAIL:
+                log.info(
+                    'Address not available when adding %s to multicast group, '
+                    'it is expected to happen on some systems', i,
+                )
+                return None
+            else:
+                raise
+
+        respond_socket = new_socket()
+        respond_socket.setsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(i))
+        if sys.platform.startswith('linux'):
+            # Unicast responses are read from this socket, multicast
+            # packets only from the listening one
+            try:
+                respond_socket.setsockopt(socket.IPPROTO_IP,
+                                          _IP_MULTICAST_ALL, 0)
+            except socket.error as e:
+                log.info('Could not clear IP_MULTICAST_ALL: %r', e)
+
+        self._interfaces[i] = respond_socket
+        self._respond_sockets = list(self._interfaces.values())
+        return respond_socket
+
+    def remove_interface(self, i):
+        """Leaves the multicast group on the interface with address i,
+        which has gone, and closes its socket"""
+        respond_socket = self._interfaces.pop(i, None)
+        if respond_socket is None:
+            return
+        self._respond_sockets = list(self._interfaces.values())
+        try:
+            self._listen_socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP,
+                socket.inet_aton(_MDNS_ADDR) + socket.inet_aton(i))
+        except socket.error as e:
+            log.debug('Could not leave multicast group on %s: %r', i, e)
+        self.engine.del_reader(respond_socket)
+        respond_socket.close()
+
+    def check_interfaces(self):
+        """Follows changes of the addresses of the interfaces.  Browsers
+        query again through new interfaces only.
+
+        The cache is shared by the interfaces, and the interface a record
+        came through isn't known.  So when an interface goes, all cached
+        records have to be confirmed again by answers through the other
+        interfaces, and browsers start their queries over."""
+        if self.done:
+            return
+        try:
+            current = set(get_all_addresses(socket.AF_INET, 0))
+        except (OSError, ValueError) as e:
+            log.warning('Could not enumerate interfaces: %r', e)
+        else:
+            gone = self.interface_addresses - current
+            for address in gone:
+                log.info('Interface %s has gone', address)
+                self.remove_interface(address)
+            if gone:
+                self.unconfirm(self.cache.entries())
+                for browser in list(self.running_browsers):
+                    browser.browse_again()
+            failed = set()
+            for address in current - self.interface_addresses:
+                log.info('Interface %s has appeared', address)
+                try:
+                    respond_socket = self.add_interface(address)
+                except socket.error as e:
+                    # Tried again by the next check
+                    log.warning('Could not use interface %s: %r', address, e)
+                    failed.add(address)
+                    continue
+                if respond_socket is None:
+                    # Not available yet, tried again by the next check
+                    failed.add(address)
+                    continue
+                self.engine.add_reader(self.listener, respond_socket)
+                for browser in list(self.running_browsers):
+                    browser.requery(respond_socket)
+            self.interface_addresses = current - failed
+            self.addresses = current | set(self._interfaces)
+        self.call_later(_INTERFACE_CHECK_TIME, self.check_interfaces)
 
     def wait(self, timeout):
         """Calling thread waits for a given number of milliseconds or
@@ -1396,6 +2583,34 @@ class Zeroconf(object):
         with self.condition:
             self.condition.notify_all()
 
+    def add_waiter(self, event, keys):
+        """Makes the event be set when a record arrives, whose
+        (lowercase name, type) is one of the keys.  A key with _TYPE_ANY
+        matches records of all types with the name."""
+        with self.waiters_lock:
+            for key in keys:
+                self.waiters.setdefault(key, set()).add(event)
+
+    def remove_waiter(self, event, keys):
+        """Stops setting the event for records with the keys."""
+        with self.waiters_lock:
+            for key in keys:
+                events = self.waiters.get(key)
+                if events is not None:
+                    events.discard(event)
+                    if not events:
+                        del self.waiters[key]
+
+    def notify_waiters(self, record):
+        """Wakes the threads waiting for records like this one"""
+        if not self.waiters:
+            return
+        with self.waiters_lock:
+            events = set(self.waiters.get((record.key, record.type), ()))
+            events.update(self.waiters.get((record.key, _TYPE_ANY), ()))
+        for event in events:
+            event.set()
+
     def get_service_info(self, type, name, timeout=3000):
         """Returns network's service information for a particular
         name and type, or None if no service matches by the timeout,
@@ -1405,6 +2620,90 @@ class Zeroconf(object):
             return info
         return None
 
+    def get_service_infos(self, type, names, timeout=3000, callback=None):
+        """Returns a dict mapping each of the names to network's service
+        information, or to None if the service didn't answer by the
+        timeout.  All services are asked for in the same queries.
+
+        callback(name, info) is called for each service as soon as it is
+        resolved, without waiting for the others."""
+        infos = [ServiceInfo(type, name) for name in names]
+        if callback is not None:
+            self.request_service_infos(
+                infos, timeout, lambda info: callback(info.name, info))
+        else:
+            self.request_service_infos(infos, timeout)
+        return dict((info.name, info if info.is_resolved() else None)
+                    for info in infos)
+
+    def request_service_infos(self, infos, timeout, callback=None):
+        """Updates the ServiceInfos with details discovered on the network.
+        Questions for all unresolved services are sent in one query, which
+        is repeated with growing delays until every service is resolved
+        or the timeout in milliseconds passes.  Returns true if all
+        services were resolved.
+
+        callback(info) is called for each ServiceInfo as soon as it is
+        resolved."""
+        now = current_time_millis()
+        delay = _LISTENER_TIME
+        next = now + delay
+        last = now + timeout
+        template = None
+        # Set by records of the pending services
+        event = threading.Event()
+        keys = set()
+        reported = set()
+        try:
+            for info in infos:
+                self.add_listener(info, DNSQuestion(info.name, _TYPE_ANY,
+                                                    _CLASS_IN))
+            while True:
+                event.clear()
+                pending = []
+                for info in infos:
+                    if not info.is_resolved():
+                        pending.append(info)
+                    elif callback is not None and id(info) not in reported:
+                        reported.add(id(info))
+                        callback(info)
+                if not pending:
+                    return True
+                if last <= now:
+                    return False
+                wanted = set()
+                for info in pending:
+                    wanted.add((info.name.lower(), _TYPE_ANY))
+                    if info.server is not None:
+                        wanted.add((info.server.lower(), _TYPE_A))
+                if wanted != keys:
+                    # A record may have arrived before the event was
+                    # registered for it, so the state is checked again
+                    self.remove_waiter(event, keys - wanted)
+                    self.add_waiter(event, wanted - keys)
+                    keys = wanted
+                    continue
+                if next <= now:
+                    questions = []
+                    answers = []
+                    # Only the first query asks for unicast responses
+                    for info in pending:
+                        info.add_query(self, now, questions, answers,
+                                       template is None)
+                    # Retransmissions reuse the packet, unless servers
+                    # became known or answers arrived meanwhile
+                    template = query_template(template, questions, answers)
+                    self.send(template)
+                    next = now + delay
+                    delay = delay * 2
+
+                event.wait((min(next, last) - now) / 1000)
+                now = current_time_millis()
+        finally:
+            self.remove_waiter(event, keys)
+            for info in infos:
+                self.remove_listener(info)
+
     def add_service_listener(self, type, listener):
         """Adds a listener for a particular service type.  This object
         will then have its update_record method called when information
@@ -1435,7 +2734,9 @@ class Zeroconf(object):
         i = 0
         while i < 3:
             if now < next_time:
-                self.wait(next_time - now)
+                # Announcements go out at fixed times, no record can
+                # change them
+                time.sleep((next_time - now) / 1000)
                 now = current_time_millis()
                 continue
             out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
@@ -1519,30 +2820,38 @@ class Zeroconf(object):
         now = current_time_millis()
         next_time = now
         i = 0
-        while i < 3:
-            for record in self.cache.entries_with_name(info.type):
-                if (record.type == _TYPE_PTR and
-                        not record.is_expired(now) and
-                        record.alias == info.name):
-                    if info.name.find('.') < 0:
-                        info.name = '%s.[%s:%s].%s' % (info.name,
-                                                       info.address, info.port, info.type)
-
-                        self.check_service(info)
-                        return
-                    raise NonUniqueNameException
-            if now < next_time:
-                self.wait(next_time - now)
-                now = current_time_millis()
-                continue
-            out = DNSOutgoing(_FLAGS_QR_QUERY | _FLAGS_AA)
-            self.debug = out
-            out.add_question(DNSQuestion(info.type, _TYPE_PTR, _CLASS_IN))
-            out.add_authorative_answer(DNSPointer(info.type, _TYPE_PTR,
-                                                  _CLASS_IN, _DNS_TTL, info.name))
-            self.send(out)
-            i += 1
-            next_time += _CHECK_TIME
+        # Set by PTR records of the type, which may claim the name
+        event = threading.Event()
+        keys = [(info.type.lower(), _TYPE_PTR)]
+        self.add_waiter(event, keys)
+        try:
+            while i < 3:
+                event.clear()
+                for record in self.cache.entries_with_name(info.type):
+                    if (record.type == _TYPE_PTR and
+                            not record.is_expired(now) and
+                            record.alias == info.name):
+                        if info.name.find('.') < 0:
+                            info.name = '%s.[%s:%s].%s' % (info.name,
+                                                           info.address, info.port, info.type)
+
+                            self.check_service(info)
+                            return
+                        raise NonUniqueNameException
+                if now < next_time:
+                    event.wait((next_time - now) / 1000)
+                    now = current_time_millis()
+                    continue
+                out = DNSOutgoing(_FLAGS_QR_QUERY | _FLAGS_AA)
+                self.debug = out
+                out.add_question(DNSQuestion(info.type, _TYPE_PTR, _CLASS_IN))
+                out.add_authorative_answer(DNSPointer(info.type, _TYPE_PTR,
+                                                      _CLASS_IN, _DNS_TTL, info.name))
+                self.send(out)
+                i += 1
+                next_time += _CHECK_TIME
+        finally:
+            self.remove_waiter(event, keys)
 
     def add_listener(self, listener, question):
         """Adds a listener for a given question.  The listener will have
@@ -1551,7 +2860,10 @@ class Zeroconf(object):
         now = current_time_millis()
         self.listeners.append(listener)
         if question is not None:
-            for record in self.cache.entries_with_name(question.name):
+            # Oldest first, so the latest record is the one listeners keep
+            records = sorted(self.cache.entries_with_name(question.name),
+                             key=lambda record: record.created)
+            for record in records:
                 if question.answered_by(record) and not record.is_expired(now):
                     listener.update_record(self, now, record)
         self.notify_all()
@@ -1569,7 +2881,105 @@ class Zeroconf(object):
         a record."""
         for listener in self.listeners:
             listener.update_record(self, now, rec)
-        self.notify_all()
+        self.notify_waiters(rec)
+
+    def is_wanted(self, record):
+        """Returns true if records like this one are refreshed, or
+        threads wait for them"""
+        return (record.key in self.interests or
+                (record.key, record.type) in self.waiters or
+                (record.key, _TYPE_ANY) in self.waiters)
+
+    def add_interest(self, name):
+        """Makes records with the given name be queried again before
+        they expire."""
+        key = name.lower()
+        with self.refresh_lock:
+            self.interests[key] = self.interests.get(key, 0) + 1
+        now = current_time_millis()
+        for record in self.cache.entries_with_name(key):
+            if not record.is_expired(now):
+                self.schedule_refresh(record)
+
+    def remove_interest(self, name):
+        """Undoes add_interest for the given name."""
+        key = name.lower()
+        with self.refresh_lock:
+            count = self.interests.get(key, 0) - 1
+            if count > 0:
+                self.interests[key] = count
+            else:
+                self.interests.pop(key, None)
+
+    def schedule_refresh(self, record):
+        """Schedules refresh queries for a record at 80, 85, 90 and 95
+        percent of its TTL, if the record is of interest."""
+        with self.refresh_lock:
+            if record.key not in self.interests:
+                return
+            times = [record.get_expiration_time(
+                percent + random.uniform(0, _REFRESH_JITTER))
+                for percent in _REFRESH_PERCENTS]
+            times.sort()
+            state = self.refresh_times.get(record)
+            if state is None or times[0] < state[0]:
+                # Entries of later times are skipped when they fall due
+                state = [times[0], times, record]
+                self.refresh_times[record] = state
+                heapq.heappush(self.refreshes,
+                               (times[0], next(self.refresh_counter),
+                                record))
+            else:
+                # The queued entry takes the new times, when it falls due
+                state[1] = times
+                state[2] = record
+            first = self.refreshes[0][0]
+        self.reaper.wake(first)
+
+    def reap(self, now):
+        """Removes expired records from the cache and sends the refresh
+        queries which are due.  Returns the time of the next expiration
+        or refresh, or None if there is nothing to do."""
+        for record in self.cache.expired(now):
+            self.update_record(now, record)
+            self.cache.remove(record)
+
+        questions = set()
+        with self.refresh_lock:
+            while self.refreshes and self.refreshes[0][0] <= now:
+                when, _, record = heapq.heappop(self.refreshes)
+                state = self.refresh_times.get(record)
+                if state is None or state[0] != when:
+                    # Superseded by an earlier entry
+                    continue
+                _, times, record = state
+                # Skip records which were removed since
+                if (record.key not in self.interests or
+                        self.cache.get(record) is not record):
+                    del self.refresh_times[record]
+                    continue
+                if times[0] <= now:
+                    questions.add((record.name, record.type))
+                times = [t for t in times if t > now]
+                if not times:
+                    del self.refresh_times[record]
+                    continue
+                state[0] = times[0]
+                state[1] = times
+                heapq.heappush(self.refreshes,
+                               (times[0], next(self.refresh_counter),
+                                record))
+            next_refresh = self.refreshes[0][0] if self.refreshes else None
+
+        if questions:
+            out = DNSOutgoing(_FLAGS_QR_QUERY)
+            for name, type_ in sorted(questions):
+                out.add_question(DNSQuestion(name, type_, _CLASS_IN))
+            self.send(out)
+
+        times = [t for t in (self.cache.next_expiration(), next_refresh)
+                 if t is not None]
+        return min(times) if times else None
 
     def handle_response(self, msg):
         """Deal with incoming response packets.  All answers
@@ -1577,19 +2987,136 @@ class Zeroconf(object):
         now = current_time_millis()
         for record in msg.answers:
             expired = record.is_expired(now)
-            if record in self.cache.entries():
+            entry = self.cache.get(record)
+            if entry is not None:
+                if self.unconfirmed:
+                    self.unconfirmed.pop(entry, None)
                 if expired:
-                    self.cache.remove(record)
+                    self.cache.remove(entry)
                 else:
-                    entry = self.cache.get(record)
-                    if entry is not None:
-                        entry.reset_ttl(record)
-                        record = entry
+                    expires = entry.get_expiration_time(100)
+                    entry.reset_ttl(record)
+                    if entry.get_expiration_time(100) < expires:
+                        self.cache.schedule(entry)
+                    record = entry
             else:
                 self.cache.add(record)
 
+            self.reaper.wake(record.get_expiration_time(100))
+            if not expired:
+                self.schedule_refresh(record)
             self.update_record(now, record)
 
+    def save_cache(self, path):
+        """Saves records of the cache, which don't expire within a
+        second, to a snapshot file"""
+        now = current_time_millis()
+        records = [record for record in self.cache.entries()
+                   if record.get_remaining_ttl(now) >= 1 and
+                   record not in self.unconfirmed]
+        chunks = [_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, int(now))]
+        for start in xrange(0, len(records), _SNAPSHOT_RECORDS):
+            out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
+            for record in records[start:start + _SNAPSHOT_RECORDS]:
+                out.add_answer_at_time(record, now)
+            packet = out.packet()
+            chunks.append(_SHORT.pack(len(packet)))
+            chunks.append(bytes(packet))
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as snapshot:
+                snapshot.write(b''.join(chunks))
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            log.warning('Failed to save cache snapshot %s: %r', path, e)
+
+    def load_cache(self, path):
+        """Adds records, which haven't expired yet, from a snapshot file
+        to the cache.  They are expired after _CONFIRM_TIME, unless an
+        answer confirms them."""
+        try:
+            with open(path, 'rb') as snapshot:
+                data = snapshot.read()
+        except (IOError, OSError):
+            return
+        records = []
+        try:
+            magic, saved_at = _SNAPSHOT_HEADER.unpack_from(data, 0)
+            if magic != _SNAPSHOT_MAGIC:
+                return
+            offset = _SNAPSHOT_HEADER.size
+            while offset < len(data):
+                length, = _SHORT.unpack_from(data, offset)
+                offset += _SHORT.size
+                msg = DNSIncoming(data[offset:offset + length],
+                                  self.record_types)
+                offset += length
+                records.extend(msg.answers)
+        except (IncomingDecodeError, struct.error, IndexError,
+                ValueError) as e:
+            log.warning('Invalid cache snapshot %s: %r', path, e)
+            return
+
+        now = current_time_millis()
+        loaded = []
+        for record in records:
+            # The TTLs were written as remaining at the time of the save
+            record.created = saved_at
+            if record.is_expired(now) or self.cache.get(record) is not None:
+                continue
+            self.cache.add(record)
+            loaded.append(record)
+            self.reaper.wake(record.get_expiration_time(100))
+        self.unconfirm(loaded)
+
+    def unconfirm(self, records):
+        """Expires the records after _CONFIRM_TIME, unless answers
+        confirm them meanwhile.  Browsers leave them out of known
+        answers, so hosts answer with them."""
+        if not records:
+            return
+        expires = current_time_millis() + _CONFIRM_TIME
+        for record in records:
+            self.unconfirmed[record] = expires
+        self.call_later(_CONFIRM_TIME, self.expire_unconfirmed)
+
+    def expire_unconfirmed(self):
+        """Expires the unconfirmed records, whose time is up"""
+        now = current_time_millis()
+        for record, expires in list(self.unconfirmed.items()):
+            if expires <= now:
+                self.unconfirmed.pop(record, None)
+                if self.cache.get(record) is record:
+                    record.ttl = 0
+                    self.cache.schedule(record)
+        self.reaper.wake(now)
+
+    def handle_foreign_query(self, msg):
+        """Deal with a query of another host, which browsers may treat
+        as their own."""
+        now = current_time_millis()
+        known_answers = None
+        for question in msg.questions:
+            # Questions asking for unicast responses don't count
+            if question.type != _TYPE_PTR or question.unique:
+                continue
+            for browser in list(self.running_browsers):
+                if browser.type.lower() == question.key:
+                    if known_answers is None:
+                        known_answers = set(msg.answers)
+                    browser.suppress_query(now, known_answers)
+
+    def call_later(self, delay, callback):
+        """Calls the callback after delay milliseconds"""
+        if self.single_thread:
+            self.engine.call_at(current_time_millis() + delay, callback)
+        else:
+            timer = threading.Timer(delay / 1000, callback)
+            timer.daemon = True
+            timer.start()
+
     def handle_query(self, msg, addr, port):
         """Deal with incoming query packets.  Provides a response if
         possible."""
@@ -1655,25 +3182,39 @@ class Zeroconf(object):
             out.id = msg.id
             self.send(out, addr, port)
 
-    def send(self, out, addr=_MDNS_ADDR, port=_MDNS_PORT):
-        """Sends an outgoing packet."""
-        packet = out.packet()
-        log.debug('Sending %r as %r...', out, packet)
-        for s in self._respond_sockets:
-            bytes_sent = s.sendto(packet, 0, (addr, port))
-            if bytes_sent != len(packet):
-                raise Error(
-                    'Should not happen, sent %d out of %d bytes' % (
-                        bytes_sent, len(packet)))
+    def send(self, out, addr=_MDNS_ADDR, port=_MDNS_PORT, sockets=None):
+        """Sends an outgoing packet, through the given sockets or all
+        interfaces."""
+        if sockets is None:
+            sockets = self._respond_sockets
+        for packet in out.packets():
+            log.debug('Sending %r as %r...', out, packet)
+            for s in sockets:
+                try:
+                    bytes_sent = s.sendto(packet, 0, (addr, port))
+                except socket.error as e:
+                    # The interface may have gone since it was checked
+                    log.debug('Sending through %r failed: %r', s, e)
+                    continue
+                if bytes_sent != len(packet):
+                    raise Error(
+                        'Should not happen, sent %d out of %d bytes' % (
+                            bytes_sent, len(packet)))
 
     def close(self):
         """Ends the background threads, and prevent this instance from
         servicing further queries."""
-        global _GLOBAL_DONE
-        if not _GLOBAL_DONE:
-            _GLOBAL_DONE = True
+        if not self.done:
+            if self.cache_path is not None:
+                self.save_cache(self.cache_path)
+            self.done = True
             self.notify_all()
+            for browser in list(self.running_browsers):
+                browser.wake()
             self.engine.notify()
+            self.reaper.wake(0)
+            if self.single_thread:
+                self.dispatcher.stop()
             self.unregister_all_services()
             for s in [self._listen_socket] + self._respond_sockets:
                 s.close()
@@ -0,0 +1,80 @@
+# zeroconf_membench.py - measures the memory used by parsed zeroconf records
+#
+# Usage: python2 tools/zeroconf_membench.py [path of zeroconf.py directory]
+#
+# The records of 200 Chromecasts are parsed, each from its own packet as
+# devices answer one by one, and their size is summed deeply, so the
+# strings and the objects they reference are counted once.
+
+from __future__ import print_function
+
+import os
+import sys
+
+
+DEVICES = 200
+LIB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, "resources", "lib")
+
+
+def deep_size(objs):
+    """ Returns the size of the objects and everything they reference. """
+    seen = set()
+    total = 0
+    stack = list(objs)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (int, long, bool, type(None))):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        for cls in getattr(type(obj), "__mro__", ()):
+            for name in getattr(cls, "__slots__", ()):
+                if hasattr(obj, name):
+                    stack.append(getattr(obj, name))
+    return total
+
+
+def device_records(zeroconf, i):
+    """ Returns the PTR, SRV, TXT and A records of a device. """
+    name = "Chromecast-Ultra-%032x._googlecast._tcp.local." % i
+    host = "%032x.local." % i
+    return [
+        zeroconf.DNSPointer("_googlecast._tcp.local.", zeroconf._TYPE_PTR,
+                            zeroconf._CLASS_IN, 4500, name),
+        zeroconf.DNSService(name, zeroconf._TYPE_SRV, zeroconf._CLASS_IN,
+                            120, 0, 0, 8009, host),
+        zeroconf.DNSText(name, zeroconf._TYPE_TXT, zeroconf._CLASS_IN, 4500,
+                         b"\x23id=%032x" % i),
+        zeroconf.DNSAddress(host, zeroconf._TYPE_A, zeroconf._CLASS_IN, 120,
+                            b"\x0a\x00\x00\x01"),
+    ]
+
+
+def parse_records(zeroconf):
+    """ Returns the records of all devices, parsed one packet each. """
+    records = []
+    for i in range(DEVICES):
+        for record in device_records(zeroconf, i):
+            out = zeroconf.DNSOutgoing(zeroconf._FLAGS_QR_RESPONSE)
+            out.add_answer_at_time(record, 0)
+            records.extend(zeroconf.DNSIncoming(out.packet()).answers)
+    return records
+
+
+def main():
+    sys.path.insert(0, sys.argv[1] if len(sys.argv) > 1 else LIB_PATH)
+    import zeroconf
+
+    records = parse_records(zeroconf)
+    print("%d records, %.0f bytes per record"
+          % (len(records), deep_size(records) / float(len(records))))
+
+
+if __name__ == "__main__":
+    main()